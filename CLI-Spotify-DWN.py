@@ -11,86 +11,900 @@
 
 import os
 import re
-import requests
-import subprocess
+import contextlib
+import random
+import argparse
 import sys
+import threading
+import collections
+import heapq
+import unicodedata
 import time
 import json
-from dotenv import load_dotenv
+import math
+
+# Spotify endpoints
+TOKEN_URL = 'https://accounts.spotify.com/api/token'
+API_URL = "https://api.spotify.com/v1"
+SEARCH_URL = API_URL + "/search"
+TRACKS_URL = API_URL + "/tracks"
+
+# Search results fetched and scored per song. 1 takes Spotify's first hit as it is
+SEARCH_CANDIDATES = 10
+# Most results Spotify returns for one search
+SEARCH_MAX_CANDIDATES = 50
+# Best matches scoring below this (0-1) are put on the review list instead of being downloaded
+MATCH_MIN_SCORE = 0.7
+
+# Most track ids the /tracks endpoint takes in one request
+TRACKS_BATCH_SIZE = 50
+# Page sizes for expanding playlists and albums
+PLAYLIST_PAGE_SIZE = 100
+ALBUM_PAGE_SIZE = 50
+
+# Size of the keep-alive connection pool shared by all Spotify requests
+HTTP_POOL_SIZE = 32
+
+# Request scheduler. Requests are let through at REQUEST_RATE per second on average (bursts of
+# up to REQUEST_BURST). The number of requests in flight starts at REQUEST_CONCURRENCY, grows by one
+# per round of successful requests and halves every time Spotify answers 429.
+REQUEST_RATE = 10
+REQUEST_BURST = 20
+REQUEST_CONCURRENCY = 4
+REQUEST_MAX_CONCURRENCY = 16
+REQUEST_MAX_RETRIES = 6
+# Exponential backoff for 5xx answers and connection errors
+REQUEST_BACKOFF_BASE = 0.5
+REQUEST_BACKOFF_MAX = 30
+
+# Access token is cached here between runs so we can skip the auth round trip
+TOKEN_CACHE_FILE = ".token_cache.json"
+# Refresh the token this many seconds before Spotify says it expires
+TOKEN_REFRESH_MARGIN = 60
+
+# Search results are cached here so re-running an import doesn't search again
+SEARCH_CACHE_FILE = ".search_cache.db"
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+# "Not found" results expire sooner in case the song gets added to Spotify
+SEARCH_CACHE_NOT_FOUND_TTL = 24 * 60 * 60
+SEARCH_CACHE_MAX_ENTRIES = 100000
+
+# Append-only record of every import entry's state, kept in the download folder so imports can resume
+MANIFEST_FILE = ".import_manifest.jsonl"
+
+# Songs whose best search result scored below MATCH_MIN_SCORE, written to the download folder
+# after an import in the import file format
+REVIEW_FILE = "import_review.json"
+
+# Import files are read this many characters at a time
+IMPORT_READ_SIZE = 64 * 1024
+
+# Index of the downloaded files, kept in the download folder
+LIBRARY_INDEX_FILE = ".library_index.db"
+LIBRARY_SCAN_WORKERS = 8
+
+# File types counted as downloaded songs
+AUDIO_EXTENSIONS = {".mp3", ".m4a", ".flac", ".opus", ".ogg", ".wav"}
+
+# Seconds of downloads the bandwidth estimate is based on
+BANDWIDTH_WINDOW = 30
+
+# Default concurrency for file imports (override with SEARCH_WORKERS / DOWNLOAD_WORKERS env variables)
+SEARCH_WORKERS = 8
+DOWNLOAD_WORKERS = 2
+# Max songs handed to a single spotDL process (override with DOWNLOAD_BATCH_SIZE env variable)
+DOWNLOAD_BATCH_SIZE = 10
+
+# Optional processing of downloaded files (tags, transcoding, ReplayGain), runs on this many
+# processes. None uses one per CPU
+POSTPROCESS_WORKERS = None
+# ffmpeg used for transcoding and loudness, None looks on the PATH and in ~/.spotdl
+FFMPEG_COMMAND = None
+# Extra ffmpeg arguments when transcoding (e.g. ["-b:a", "160k"])
+TRANSCODE_ARGS = []
+# ReplayGain 2.0 reference loudness in LUFS
+REPLAYGAIN_REFERENCE = -18.0
+
+# Command used to run spotDL, songs are downloaded with "<command> <urls> --output <folder>"
+SPOTDL_COMMAND = [sys.executable, "-m", "spotdl"]
+# Extra arguments added to every spotDL command (e.g. ["--format", "flac"])
+SPOTDL_ARGS = []
+# Where spotDL's output goes, None shows it in the terminal
+SPOTDL_OUTPUT = None
+
+# Watch mode: inbox polled every WATCH_INTERVAL seconds, files are read once they haven't changed
+# for WATCH_SETTLE_TIME seconds and at most WATCH_BATCH queued songs are imported at a time.
+# The queue is kept in the inbox folder and its status served on 127.0.0.1:WATCH_STATUS_PORT
+WATCH_INTERVAL = 5
+WATCH_SETTLE_TIME = 2
+WATCH_BATCH = 200
+WATCH_QUEUE_FILE = ".watch_queue.db"
+WATCH_STATUS_PORT = 8765
+
+# Sharded imports: songs are published to a SQLite queue on storage every node can reach and
+# leased SHARD_BATCH at a time by workers. A lease runs out after SHARD_LEASE_TIME seconds
+# without a heartbeat (worker crashed) and its songs are queued again, up to SHARD_MAX_ATTEMPTS times
+SHARD_BATCH = 50
+SHARD_LEASE_TIME = 300
+SHARD_MAX_ATTEMPTS = 3
+SHARD_POLL_INTERVAL = 10
+# Seconds between tries to get an album folder another node is downloading into
+SHARD_FOLDER_POLL_INTERVAL = 1
+# Seconds to wait for another node's write to the queue to finish
+SHARD_DB_TIMEOUT = 60
+
+# Exit codes of the command line interface
+EXIT_OK = 0
+EXIT_FAILED = 1  # Some songs weren't found or couldn't be downloaded
+EXIT_USAGE = 2  # Bad arguments (used by argparse)
+EXIT_AUTH = 3  # Missing or invalid API keys
+EXIT_INPUT = 4  # Import file or download folder can't be used
+
+
+# Collects timings and counters for a batch: per-track latency of each stage (token, search,
+# mkdir, download), spotDL exit codes, bytes written, retries and cache hits
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.counters = {}
+            self.exit_codes = {}
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.stages.setdefault(stage, []).append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def exit_code(self, code):
+        with self.lock:
+            self.exit_codes[code] = self.exit_codes.get(code, 0) + 1
+
+    # Nearest-rank percentile of a sorted list
+    def percentile(self, values, percent):
+        if not values:
+            return 0.0
+        rank = max(1, math.ceil(percent / 100 * len(values)))
+        return values[min(rank, len(values)) - 1]
+
+    # Plain dict of everything collected, used by the summary and the exports
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            stages = {}
+            for stage, values in self.stages.items():
+                values = sorted(values)
+                stages[stage] = {
+                    "count": len(values),
+                    "total": sum(values),
+                    "p50": self.percentile(values, 50),
+                    "p95": self.percentile(values, 95),
+                    "p99": self.percentile(values, 99),
+                    "max": values[-1],
+                }
+            counters = dict(self.counters)
+            exit_codes = {str(code): count for code, count in self.exit_codes.items()}
+        downloaded = counters.get("tracks_downloaded", 0)
+        return {
+            "started": self.started,
+            "elapsed": elapsed,
+            "tracks_per_minute": downloaded / elapsed * 60,
+            "stages": stages,
+            "counters": counters,
+            "spotdl_exit_codes": exit_codes,
+        }
+
+    def print_summary(self):
+        snap = self.snapshot()
+        print(f"\nFinished in {snap['elapsed']:.1f}s, {snap['tracks_per_minute']:.1f} tracks/min")
+        if snap["stages"]:
+            print(f"\n  {'stage':<12}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'total':>10}")
+            for stage in ("token", "search", "mkdir", "download", "postprocess"):
+                if stage in snap["stages"]:
+                    st = snap["stages"][stage]
+                    print(f"  {stage:<12}{st['count']:>7}{st['p50']:>8.2f}s{st['p95']:>8.2f}s{st['p99']:>8.2f}s{st['total']:>9.1f}s")
+        counters = snap["counters"]
+        print(f"\n  bytes written: {counters.get('bytes_written', 0)}")
+        print(f"  retries: {counters.get('retries', 0)}")
+        print(f"  cache hits: {counters.get('cache_hits', 0)}")
+        if counters.get("postprocessed") or counters.get("postprocess_failed"):
+            print(f"  post-processed: {counters.get('postprocessed', 0)} ({counters.get('postprocess_failed', 0)} failed)")
+        if snap["spotdl_exit_codes"]:
+            codes = ", ".join(f"{code}: {count}" for code, count in sorted(snap["spotdl_exit_codes"].items()))
+            print(f"  spotDL exit codes: {codes}")
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    # Prometheus node_exporter textfile format. Written to a temp file first so the
+    # collector never reads a half written file
+    def write_prometheus(self, path):
+        snap = self.snapshot()
+        lines = [
+            "# HELP spotify_dl_stage_seconds Time spent per track in each import stage.",
+            "# TYPE spotify_dl_stage_seconds summary",
+        ]
+        for stage, st in snap["stages"].items():
+            for quantile in ("50", "95", "99"):
+                lines.append(f'spotify_dl_stage_seconds{{stage="{stage}",quantile="0.{quantile}"}} {st["p" + quantile]}')
+            lines.append(f'spotify_dl_stage_seconds_sum{{stage="{stage}"}} {st["total"]}')
+            lines.append(f'spotify_dl_stage_seconds_count{{stage="{stage}"}} {st["count"]}')
+        lines.append("# HELP spotify_dl_events_total Counters for the last import.")
+        lines.append("# TYPE spotify_dl_events_total counter")
+        for name, value in sorted(snap["counters"].items()):
+            lines.append(f'spotify_dl_events_total{{event="{name}"}} {value}')
+        lines.append("# HELP spotify_dl_spotdl_exits_total spotDL processes by exit code.")
+        lines.append("# TYPE spotify_dl_spotdl_exits_total counter")
+        for code, count in sorted(snap["spotdl_exit_codes"].items()):
+            lines.append(f'spotify_dl_spotdl_exits_total{{code="{code}"}} {count}')
+        lines.append("# HELP spotify_dl_tracks_per_minute Download throughput of the last import.")
+        lines.append("# TYPE spotify_dl_tracks_per_minute gauge")
+        lines.append(f"spotify_dl_tracks_per_minute {snap['tracks_per_minute']}")
+        lines.append("# TYPE spotify_dl_last_run_timestamp_seconds gauge")
+        lines.append(f"spotify_dl_last_run_timestamp_seconds {snap['started']}")
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+
+# Metrics of the current batch
+metrics = Metrics()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+# Shared HTTP session so all Spotify requests reuse keep-alive connections instead of a new TCP+TLS handshake each
+def get_session():
+    global _session
+    # Imported here so the command line starts without loading requests
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _session_lock:
+        if _session == None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+# Sends every Spotify request. Spaces requests out with a token bucket, waits out
+# 429 Retry-After, retries 5xx and connection errors with jittered exponential backoff
+# and adapts how many requests run at once (additive increase, multiplicative decrease).
+class RequestScheduler:
+    def __init__(self, rate=REQUEST_RATE, burst=REQUEST_BURST, concurrency=REQUEST_CONCURRENCY,
+                 max_concurrency=REQUEST_MAX_CONCURRENCY, max_retries=REQUEST_MAX_RETRIES):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.limit = float(concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.active = 0
+        self.paused_until = 0
+        self.cond = threading.Condition()
+        # Counters
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+
+    # Waits for a free slot and a token from the bucket
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.cond.wait(self.paused_until - now)
+                    continue
+                if self.active >= int(self.limit):
+                    self.cond.wait()
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    self.cond.wait((1 - self.tokens) / self.rate)
+                    continue
+                self.tokens -= 1
+                self.active += 1
+                self.requests += 1
+                return
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    # Stop sending requests for a while (Spotify's Retry-After)
+    def pause(self, seconds):
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.cond.notify_all()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(REQUEST_BACKOFF_MAX, REQUEST_BACKOFF_BASE * 2 ** attempt))
+
+    # Sends a request, retrying until it succeeds or max_retries is reached.
+    # Returns the last response, raises the last error if the request never got through
+    def request(self, method, url, **kwargs):
+        import requests
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = get_session().request(method, url, **kwargs)
+            except requests.RequestException:
+                self.release()
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if response.status_code == 429:
+                    self.release(throttled=True)
+                    if attempt >= self.max_retries:
+                        return response
+                    try:
+                        retry_after = float(response.headers.get("Retry-After"))
+                    except (TypeError, ValueError):
+                        retry_after = self.backoff(attempt)
+                    self.pause(retry_after)
+                    # Spread the retries out a little once the pause is over
+                    delay = random.uniform(0, 1)
+                elif response.status_code >= 500:
+                    self.release()
+                    if attempt >= self.max_retries:
+                        return response
+                    delay = self.backoff(attempt)
+                else:
+                    self.release()
+                    return response
+            attempt += 1
+            with self.cond:
+                self.retries += 1
+            metrics.count("retries")
+            time.sleep(delay)
 
-# Get API token using Client ID and Client Secret
-def generate_token(CLIENT_ID, CLIENT_SECRET):
-    auth_response = requests.post('https://accounts.spotify.com/api/token', data={
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler == None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+# Every Spotify request goes through here
+def spotify_request(method, url, **kwargs):
+    return get_scheduler().request(method, url, **kwargs)
+
+
+# Request a new token using Client ID and Client Secret. Returns the json response (access_token, expires_in)
+def request_token(CLIENT_ID, CLIENT_SECRET):
+    auth_response = spotify_request("POST", TOKEN_URL, data={
         'grant_type': 'client_credentials',
         'client_id': CLIENT_ID,
         'client_secret': CLIENT_SECRET,
     })
     try:
-        access_token = auth_response.json()['access_token']
-        return access_token
+        token_data = auth_response.json()
+        if 'access_token' not in token_data:
+            return None
+        return token_data
     except:
         return None
 
 
-# Searches spotify song after taking name and artist as input with spotify API access token generated from generate token function
-def search_spotify_song(access_token, song_name, artist_name):
-    headers = {
-        "Authorization": f"Bearer {access_token}"
+# Get API token using Client ID and Client Secret
+def generate_token(CLIENT_ID, CLIENT_SECRET):
+    token_data = request_token(CLIENT_ID, CLIENT_SECRET)
+    if token_data == None:
+        return None
+    return token_data['access_token']
+
+
+# Holds the access token and refreshes it just before it expires.
+# Optionally persists the token to disk so repeated runs reuse it.
+class TokenManager:
+    def __init__(self, client_id, client_secret, cache_file=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.cache_file = cache_file
+        self.access_token = None
+        self.expires_at = 0
+        self.lock = threading.Lock()
+        self.load_cache()
+
+    def load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        # Token belongs to a different set of API keys
+        if cached.get('client_id') != self.client_id:
+            return
+        self.access_token = cached.get('access_token')
+        self.expires_at = cached.get('expires_at', 0)
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            # Token is a credential, keep it readable by the owner only
+            fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'client_id': self.client_id,
+                    'access_token': self.access_token,
+                    'expires_at': self.expires_at,
+                }, f)
+        except OSError:
+            pass
+
+    def is_valid(self):
+        return self.access_token != None and time.time() < self.expires_at - TOKEN_REFRESH_MARGIN
+
+    # Returns a valid access token, refreshing it if needed. None if keys are bad
+    def get_token(self):
+        with self.lock:
+            if self.is_valid():
+                return self.access_token
+            with metrics.timer("token"):
+                token_data = request_token(self.client_id, self.client_secret)
+            if token_data == None:
+                self.access_token = None
+                self.expires_at = 0
+                return None
+            self.access_token = token_data['access_token']
+            self.expires_at = time.time() + int(token_data.get('expires_in', 3600))
+            self.save_cache()
+            return self.access_token
+
+    # Drop the current token (e.g. after a 401) so the next call fetches a new one
+    def invalidate(self, token=None):
+        with self.lock:
+            if token == None or token == self.access_token:
+                self.access_token = None
+                self.expires_at = 0
+
+
+# GET request to the Spotify API using the token manager. Retries once with a fresh token on 401
+def spotify_get(token_manager, url, params=None):
+    response = None
+    for _ in range(2):
+        token = token_manager.get_token()
+        if token == None:
+            return None
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+        response = spotify_request("GET", url, headers=headers, params=params)
+        if response.status_code != 401:
+            return response
+        token_manager.invalidate(token)
+    return response
+
+
+# Noise dropped from titles before comparing: "(feat. X)", " ft. X", "[with X]", "(2011 Remaster)", "- Remastered"
+FEAT_PATTERN = re.compile(r'[(\[]\s*(?:feat\.?|ft\.?|featuring|with)\s[^)\]]*[)\]]|\s(?:feat\.?|ft\.?|featuring)\s.*$')
+REMASTER_PATTERN = re.compile(r'[(\[][^)\]]*\bremaster(?:ed)?\b[^)\]]*[)\]]|\s-\s[^-]*\bremaster(?:ed)?\b.*$')
+# Words that mark another recording than the studio version, unless the search asks for it too
+ALT_VERSION_PATTERN = re.compile(r'\b(?:live|karaoke|instrumental|acoustic|unplugged|cover|tribute|remix|demo|rehearsal|'
+                                 r'sped up|slowed|reverb|8 bit|made famous|in the style of|originally performed)\b')
+# Album names of live records: "(Live)", "Live at ...", "Live from ...", "MTV Unplugged". Plain words like
+# "Live Through This" don't count
+LIVE_ALBUM_PATTERN = re.compile(r'[(\[]\s*live\b|\blive\s+(?:at|from|in|on)\b|\bunplugged\b', re.IGNORECASE)
+# Separators between artist names
+ARTIST_SEPARATORS = re.compile(r'\s*(?:,|;|&|\+|/|\bfeat\.?|\bft\.?|\bfeaturing\b|\band\b|\bx\b|\bwith\b)\s*')
+NON_WORD = re.compile(r'[\W_]+')
+
+
+# Casefolds and strips accents so "Beyoncé" and "BEYONCE" compare equal
+def normalize_text(text):
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def normalize_title(title):
+    text = normalize_text(title)
+    text = FEAT_PATTERN.sub(" ", text)
+    text = REMASTER_PATTERN.sub(" ", text)
+    text = " ".join(NON_WORD.sub(" ", text).split())
+    # Titles that are only punctuation
+    return text or " ".join(title.casefold().split())
+
+
+# Artist names in a fixed order so "A, B", "B & A" and "A feat. B" compare equal
+def normalize_artists(artists):
+    names = {" ".join(NON_WORD.sub(" ", name).split()) for name in ARTIST_SEPARATORS.split(normalize_text(artists))}
+    names.discard("")
+    return ", ".join(sorted(names)) or " ".join(artists.casefold().split())
+
+
+# Normalizes a search so variants of the same song share a cache entry and are only downloaded once
+def normalize_search(song_name, artist_name):
+    return normalize_title(song_name), normalize_artists(artist_name)
+
+
+# 16 byte digest of a normalized search, a compact key for the per-song tables of big imports.
+# Also takes the normalized (title, artists) pair stored in the manifest
+def search_digest(song_name, artist_name, normalized=False):
+    import hashlib
+    key = (song_name, artist_name) if normalized else normalize_search(song_name, artist_name)
+    return hashlib.blake2b("\x1f".join(key).encode("utf-8"), digest_size=16).digest()
+
+
+# Persistent cache of search results stored in SQLite.
+# Entries expire after ttl seconds and the least recently used ones are
+# evicted once there are more than max_entries.
+class SearchCache:
+    def __init__(self, path, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Refresh skips cached results but still stores the new ones
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS searches (
+                song_name TEXT NOT NULL,
+                artist_name TEXT NOT NULL,
+                track TEXT,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                candidates INTEGER,
+                PRIMARY KEY (song_name, artist_name)
+            )""")
+        # Caches made before results were scored have no candidates column, their entries are missed
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(searches)")]
+        if "candidates" not in columns:
+            self.conn.execute("ALTER TABLE searches ADD COLUMN candidates INTEGER")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS searches_last_used ON searches (last_used)")
+        self.conn.commit()
+        self.count = self.conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+
+    # Returns (True, track) on a hit where track is None for a cached "not found", (False, None) on a miss.
+    # Results picked from a different number of candidates are a miss
+    def get(self, song_name, artist_name, candidates=None):
+        if self.refresh:
+            return False, None
+        key = normalize_search(song_name, artist_name)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT track, created, candidates FROM searches WHERE song_name = ? AND artist_name = ?", key).fetchone()
+            if row == None or row[2] != candidates:
+                return False, None
+            track = json.loads(row[0]) if row[0] else None
+            # Songs that weren't found are retried sooner than found ones
+            ttl = self.ttl if track else min(self.ttl, SEARCH_CACHE_NOT_FOUND_TTL)
+            if now - row[1] > ttl:
+                self.conn.execute("DELETE FROM searches WHERE song_name = ? AND artist_name = ?", key)
+                self.conn.commit()
+                self.count -= 1
+                return False, None
+            self.conn.execute(
+                "UPDATE searches SET last_used = ? WHERE song_name = ? AND artist_name = ?", (now,) + key)
+            self.conn.commit()
+        return True, track
+
+    def put(self, song_name, artist_name, track, candidates=None):
+        key = normalize_search(song_name, artist_name)
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE searches SET track = ?, created = ?, last_used = ?, candidates = ? WHERE song_name = ? AND artist_name = ?",
+                (json.dumps(track) if track else None, now, now, candidates) + key)
+            if cursor.rowcount == 0:
+                self.conn.execute(
+                    "INSERT INTO searches (song_name, artist_name, track, created, last_used, candidates) VALUES (?, ?, ?, ?, ?, ?)",
+                    key + (json.dumps(track) if track else None, now, now, candidates))
+                self.count += 1
+            if self.count > self.max_entries:
+                self.evict()
+            self.conn.commit()
+
+    # Drop the least recently used entries, leaves some room so we don't evict on every insert
+    def evict(self):
+        keep = int(self.max_entries * 0.9)
+        self.conn.execute(
+            "DELETE FROM searches WHERE rowid IN (SELECT rowid FROM searches ORDER BY last_used LIMIT ?)",
+            (self.count - keep,))
+        self.count = self.conn.execute("SELECT COUNT(*) FROM searches").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Pulls the fields we use out of a Spotify track object
+def parse_track(track):
+    return {
+        "artist": ", ".join(artist["name"] for artist in track["artists"]),
+        "album": track["album"]["name"],
+        "name": track["name"],
+        "url": track["external_urls"]["spotify"],
+        "id": track.get("id"),
+        "duration_ms": track.get("duration_ms"),
+        "popularity": track.get("popularity"),
+        "album_type": track["album"].get("album_type"),
     }
+
+
+# Scores search results (parse_track dicts) against the song that was searched for, 0 to 1:
+# title and artist similarity, duration close to the other results with the same title,
+# and popularity. Live/karaoke/cover/... versions the search didn't ask for (by the track title,
+# or a live album name) and compilations are penalized. Returns (score, track) pairs in the order they were given
+def score_tracks(song_name, artist_name, tracks):
+    from difflib import SequenceMatcher
+    title, artists = normalize_search(song_name, artist_name)
+    title_words = set(title.split())
+    wanted_artists = set(artists.split(", "))
+    wanted_versions = set(ALT_VERSION_PATTERN.findall(title))
+
+    candidates = [(track, normalize_title(track["name"]), normalize_artists(track["artist"])) for track in tracks]
+    # The studio version is usually the most common length among the results with the right title
+    durations = sorted(track["duration_ms"] for track, name, _ in candidates if name == title and track["duration_ms"])
+    typical_duration = durations[len(durations) // 2] if durations else None
+
+    scored = []
+    for track, name, names in candidates:
+        title_score = SequenceMatcher(None, title, name).ratio()
+        # "Song - Radio Edit" and the like still contain every word of the title
+        if title_words <= set(name.split()):
+            title_score = max(title_score, 0.85)
+        found_artists = set(names.split(", "))
+        artist_ratio = SequenceMatcher(None, artists, names).ratio()
+        # Low similarity between different names is noise, only spelling variants count
+        artist_score = max(len(wanted_artists & found_artists) / len(wanted_artists),
+                           artist_ratio if artist_ratio >= 0.6 else 0.0)
+        duration_score = 1.0
+        if typical_duration and track["duration_ms"]:
+            duration_score = max(0.0, 1 - abs(track["duration_ms"] - typical_duration) / 30000)
+        popularity_score = (track.get("popularity") or 0) / 100
+
+        score = 0.4 * title_score + 0.35 * artist_score + 0.1 * duration_score + 0.15 * popularity_score
+        versions = set(ALT_VERSION_PATTERN.findall(name))
+        if LIVE_ALBUM_PATTERN.search(track["album"]):
+            versions.add("live")
+        if versions - wanted_versions:
+            score -= 0.35
+        if track.get("album_type") == "compilation":
+            score -= 0.1
+        scored.append((max(0.0, min(1.0, score)), track))
+    return scored
+
+
+# Best match is good enough to download without asking. Tracks that weren't scored always are
+def is_confident(track):
+    return track.get("score") == None or track["score"] >= MATCH_MIN_SCORE
+
+
+# Searches for a song on Spotify (or the search cache if given). Returns a track dict from parse_track,
+# None if no song matched. Raises ValueError if the search itself failed
+def find_spotify_track(token_manager, song_name, artist_name, search_cache=None):
+    candidates = min(max(1, SEARCH_CANDIDATES), SEARCH_MAX_CANDIDATES)
+    if search_cache != None:
+        hit, track = search_cache.get(song_name, artist_name, candidates)
+        metrics.count("cache_hits" if hit else "cache_misses")
+        if hit:
+            if track == None:
+                print(f"No matching tracks found for '{song_name}' by '{artist_name}'. (cached)")
+            else:
+                print(f"'{track['name']}' by {track['artist']} on album '{track['album']}' found. (cached)")
+            return track
+
     query = f"track:{song_name} artist:{artist_name}"
     params = {
         "q": query,
         "type": "track",
-        "limit": 1
+        "limit": candidates
     }
-    search_url = "https://api.spotify.com/v1/search"
 
-    response = requests.get(search_url, headers=headers, params=params)
+    with metrics.timer("search"):
+        response = spotify_get(token_manager, SEARCH_URL, params)
+    if response == None:
+        raise ValueError("Unable to acquire token. Check your API keys.")
     if response.status_code != 200:
-        print(f"Spotify API search failed: {response.status_code} {response.text}")
-        return None, None, None, None
+        raise ValueError(f"Spotify API search failed: {response.status_code} {response.text}")
 
     results = response.json()
     tracks = results.get("tracks", {}).get("items", [])
     if not tracks:
         print(f"No matching tracks found for '{song_name}' by '{artist_name}'.")
-        return None, None, None, None
+        if search_cache != None:
+            search_cache.put(song_name, artist_name, None, candidates)
+        return None
 
-    track = tracks[0]
-    track_name = track["name"]
-    track_artist = ", ".join(artist["name"] for artist in track["artists"])
-    album_name = track["album"]["name"]
-    track_url = track["external_urls"]["spotify"]
+    if candidates > 1:
+        # Highest score wins, Spotify's order breaks ties
+        scored = score_tracks(song_name, artist_name, [parse_track(t) for t in tracks])
+        score, track = max(scored, key=lambda pair: pair[0])
+        track["score"] = round(score, 3)
+    else:
+        track = parse_track(tracks[0])
+    if search_cache != None:
+        search_cache.put(song_name, artist_name, track, candidates)
+
+    if is_confident(track):
+        print(f"'{track['name']}' by {track['artist']} on album '{track['album']}' found.")
+    else:
+        print(f"'{track['name']}' by {track['artist']} on album '{track['album']}' found, but it may not be the right song (score {track['score']:.2f}).")
+    #print(f"Spotify URL: {track['url']}")
+
+    return track
+
+
+# Finds the type and id of a Spotify link, "spotify:" uri or bare track id.
+# Returns (kind, id) where kind is track, album or playlist, or (None, None)
+def parse_spotify_url(text):
+    text = text.strip()
+    match = re.search(r'open\.spotify\.com/(?:intl-[\w-]+/)?(track|album|playlist)/([A-Za-z0-9]+)', text)
+    if match == None:
+        match = re.fullmatch(r'spotify:(track|album|playlist):([A-Za-z0-9]+)', text)
+    if match != None:
+        return match.group(1), match.group(2)
+    if re.fullmatch(r'[A-Za-z0-9]{22}', text):
+        return "track", text
+    return None, None
+
+
+# Looks up tracks by id, TRACKS_BATCH_SIZE ids per request. Yields a track dict for each id
+# (None for ids Spotify doesn't know). Raises ValueError if a request fails.
+def fetch_tracks(token_manager, track_ids):
+    track_ids = list(track_ids)
+    for start in range(0, len(track_ids), TRACKS_BATCH_SIZE):
+        chunk = track_ids[start:start + TRACKS_BATCH_SIZE]
+        response = spotify_get(token_manager, TRACKS_URL, {"ids": ",".join(chunk)})
+        if response == None:
+            raise ValueError("Unable to acquire token. Check your API keys.")
+        if response.status_code != 200:
+            raise ValueError(f"Spotify API track lookup failed: {response.status_code} {response.text}")
+        for track in response.json().get("tracks", []):
+            yield parse_track(track) if track else None
+
+
+# Yields every track of a playlist, following the paginated results
+def fetch_playlist_tracks(token_manager, playlist_id):
+    url = f"{API_URL}/playlists/{playlist_id}/tracks"
+    params = {
+        "limit": PLAYLIST_PAGE_SIZE,
+        "fields": "next,items(track(id,name,duration_ms,type,is_local,artists(name),album(name),external_urls))",
+    }
+    while url:
+        response = spotify_get(token_manager, url, params)
+        if response == None:
+            raise ValueError("Unable to acquire token. Check your API keys.")
+        if response.status_code != 200:
+            raise ValueError(f"Spotify API playlist lookup failed: {response.status_code} {response.text}")
+        page = response.json()
+        for item in page.get("items", []):
+            track = item.get("track")
+            # Skip removed tracks, local files and podcast episodes
+            if not track or track.get("is_local") or track.get("type", "track") != "track":
+                continue
+            yield parse_track(track)
+        # "next" already has the query string
+        url = page.get("next")
+        params = None
+
+
+# Yields every track of an album, following the paginated results
+def fetch_album_tracks(token_manager, album_id):
+    response = spotify_get(token_manager, f"{API_URL}/albums/{album_id}")
+    if response == None:
+        raise ValueError("Unable to acquire token. Check your API keys.")
+    if response.status_code != 200:
+        raise ValueError(f"Spotify API album lookup failed: {response.status_code} {response.text}")
+    album = response.json()
+    page = album.get("tracks", {})
+    while True:
+        for track in page.get("items", []):
+            # Album tracks don't include the album
+            track["album"] = {"name": album["name"]}
+            yield parse_track(track)
+        if not page.get("next"):
+            break
+        response = spotify_get(token_manager, page["next"])
+        if response == None or response.status_code != 200:
+            raise ValueError(f"Spotify API album lookup failed for '{album['name']}'")
+        page = response.json()
+
+
+# Turns the import entries into work for run_import. (song_name, artist_name) entries are
+# passed on to be searched. Links and ids are looked up in bulk and passed on as track dicts,
+# entries that can't be looked up become {"entry": ..., "error": ...}.
+def expand_import_entries(token_manager, entries):
+    import requests
+    track_ids = []
+
+    def flush():
+        try:
+            tracks = list(fetch_tracks(token_manager, track_ids))
+        except (ValueError, requests.RequestException) as e:
+            tracks = [{"entry": track_id, "error": str(e)} for track_id in track_ids]
+        for track_id, track in zip(track_ids, tracks):
+            yield track if track != None else {"entry": track_id, "error": "Track not found on Spotify"}
+        track_ids.clear()
+
+    for entry in entries:
+        if isinstance(entry, tuple):
+            yield entry
+            continue
+        kind, spotify_id = parse_spotify_url(entry)
+        if kind == "track":
+            track_ids.append(spotify_id)
+            if len(track_ids) >= TRACKS_BATCH_SIZE:
+                yield from flush()
+        elif kind in ("album", "playlist"):
+            fetch = fetch_album_tracks if kind == "album" else fetch_playlist_tracks
+            try:
+                yield from fetch(token_manager, spotify_id)
+            except (ValueError, requests.RequestException) as e:
+                yield {"entry": entry, "error": str(e)}
+        else:
+            yield {"entry": entry, "error": "Not a Spotify track, album or playlist link"}
 
-    print(f"'{track_name}' by {track_artist} on album '{album_name}' found.")
-    #print(f"Spotify URL: {track_url}")
+    if track_ids:
+        yield from flush()
 
-    return track_artist, album_name, track_name, track_url
 
-    
-    response = requests.get(search_url, headers=headers, params=params)
-    if response.status_code != 200:
-        print(f"Spotify API search failed: {response.status_code} {response.text}")
-        return None
-    
-    results = response.json()
-    tracks = results.get("tracks", {}).get("items", [])
-    if not tracks:
-        print(f"No matching tracks found for '{song_name}' by '{artist_name}'.")
-        return None
+# Searches spotify song after taking name and artist as input using the token manager for the access token
+def search_spotify_song(token_manager, song_name, artist_name, search_cache=None):
+    import requests
+    try:
+        track = find_spotify_track(token_manager, song_name, artist_name, search_cache)
+    except (ValueError, requests.RequestException) as e:
+        print(e)
+        return None, None, None, None
+    if track == None:
+        return None, None, None, None
+    return track["artist"], track["album"], track["name"], track["url"]
 
-    track = tracks[0]
-    track_name = track["name"]
-    track_artist = ", ".join(artist["name"] for artist in track["artists"])
-    track_url = track["external_urls"]["spotify"]
 
-    print(f"Found song: '{track_name}' by {track_artist}")
-    print(f"Spotify URL: {track_url}")
-    return track_url
+# Folders already made or checked by set_folder / create_song_folder_structure
+_known_folders = set()
 
 
 # Setting destination folder function given path
 def set_folder(givn_folder):
+    if givn_folder in _known_folders:
+        return givn_folder
+    _known_folders.add(givn_folder)
     if not os.path.exists(givn_folder): # If folder doesn't exist. Make it
         os.makedirs(givn_folder)
         #print(f"Folder made at '{givn_folder}'")
@@ -101,18 +915,84 @@ def set_folder(givn_folder):
         return givn_folder
 
 
-# Download sepcific song function given path using spotDL
-def download_spotify_url(spotify_url, output_folder):
-    command = [sys.executable, "-m", "spotdl", spotify_url]
+# Sizes of the files currently in a folder
+def folder_file_sizes(folder):
+    sizes = {}
+    try:
+        for entry in os.scandir(folder or "."):
+            try:
+                sizes[entry.name] = entry.stat().st_size
+            except OSError:
+                continue
+    except OSError:
+        pass
+    return sizes
+
+
+# Runs one spotDL process for the given songs. Records its wall time, exit code and the bytes
+# it wrote. Returns (success, names of the files it added or changed)
+def run_spotdl(spotify_urls, output_folder):
+    import subprocess
+    command = SPOTDL_COMMAND + spotify_urls + SPOTDL_ARGS
     
     if output_folder:
         command.extend(["--output", output_folder])
-    
+
+    before = folder_file_sizes(output_folder)
+    start = time.perf_counter()
     try:
-        subprocess.check_call(command)
-        #print(f"Downloaded from {spotify_url} successfully.")
+        subprocess.check_call(command, stdout=SPOTDL_OUTPUT)
+        exit_code = 0
     except subprocess.CalledProcessError as e:
         print(f"Error during download: {e}")
+        exit_code = e.returncode
+    metrics.record("download", time.perf_counter() - start)
+    metrics.exit_code(exit_code)
+
+    after = folder_file_sizes(output_folder)
+    new_files = [name for name, size in after.items() if before.get(name) != size]
+    metrics.count("bytes_written", sum(after[name] for name in new_files))
+    return exit_code == 0, new_files
+
+
+# Download sepcific song function given path using spotDL
+def download_spotify_url(spotify_url, output_folder):
+    success, _ = run_spotdl([spotify_url], output_folder)
+    #print(f"Downloaded from {spotify_url} successfully.")
+    return success
+
+
+# Download several songs into the same folder with a single spotDL process.
+# Saves the interpreter/spotDL/ffmpeg startup for every song after the first.
+# names maps every url to the (artist, song name) spotDL names its file after, so the
+# songs can be checked one by one in the folder. Returns a dict of url -> True/False
+def download_spotify_urls(spotify_urls, output_folder, names=None):
+    spotify_urls = list(dict.fromkeys(spotify_urls))
+
+    def found(url):
+        return names == None or find_song_file(output_folder, *names[url]) != None
+
+    if len(spotify_urls) == 1:
+        url = spotify_urls[0]
+        return {url: download_spotify_url(url, output_folder) and found(url)}
+
+    success, new_files = run_spotdl(spotify_urls, output_folder)
+    if names != None:
+        # Songs that were already in the folder count as well, only the missing ones are retried
+        outcome = {url: found(url) for url in spotify_urls}
+    elif success and len(new_files) >= len(spotify_urls):
+        return {url: True for url in spotify_urls}
+    else:
+        # Without the names, one process can't tell us which songs failed
+        outcome = {url: False for url in spotify_urls}
+
+    # Retry the rest one by one, spotDL skips the songs that were already downloaded by the batch
+    missing = [url for url in spotify_urls if not outcome[url]]
+    if missing:
+        metrics.count("retries", len(missing))
+    for url in missing:
+        outcome[url] = download_spotify_url(url, output_folder) and found(url)
+    return outcome
 
 def sanitize_filename(name):
     # Remove illegal characters for file/folder names
@@ -131,10 +1011,162 @@ def create_song_folder_structure(dest_path, artist, playlist, song_name):
     safe_playlist = sanitize_filename(playlist)
     artist_folder = os.path.join(dest_path, safe_artist)
     playlist_folder = os.path.join(artist_folder, safe_playlist)
-    os.makedirs(playlist_folder, exist_ok=True)
+    # Folders made earlier in this run don't need another makedirs
+    if playlist_folder not in _known_folders:
+        with metrics.timer("mkdir"):
+            os.makedirs(playlist_folder, exist_ok=True)
+        _known_folders.add(playlist_folder)
     return playlist_folder
 
 
+# Finds the file spotDL wrote for a song ("Artist - Title.ext"), matched the same way as LibraryIndex
+def find_song_file(folder, artist, song_name):
+    wanted = re.sub(r'\W+', '', f"{artist} - {song_name}".casefold())
+    try:
+        entries = list(os.scandir(folder))
+    except OSError:
+        return None
+    for entry in entries:
+        stem, ext = os.path.splitext(entry.name)
+        if ext.lower() in AUDIO_EXTENSIONS and re.sub(r'\W+', '', stem.casefold()) == wanted:
+            return entry.path
+    return None
+
+
+# ffmpeg from FFMPEG_COMMAND, the PATH or the one "spotdl --download-ffmpeg" installs. None if there is none
+def find_ffmpeg():
+    import shutil
+    if FFMPEG_COMMAND != None:
+        return FFMPEG_COMMAND
+    path = shutil.which("ffmpeg")
+    if path == None:
+        local = os.path.join(os.path.expanduser("~"), ".spotdl", "ffmpeg.exe" if os.name == "nt" else "ffmpeg")
+        if os.path.exists(local):
+            path = local
+    return path
+
+
+# Options for process_audio_file, None when there is nothing to do.
+# Raises ValueError when a tool the options need is missing
+def postprocess_options(tags=False, transcode=None, loudness=False):
+    import importlib.util
+    if not (tags or transcode or loudness):
+        return None
+    if transcode:
+        transcode = transcode.lower().lstrip(".")
+        if "." + transcode not in AUDIO_EXTENSIONS:
+            raise ValueError(f"Can't transcode to '{transcode}' (use one of {', '.join(sorted(e[1:] for e in AUDIO_EXTENSIONS))})")
+    ffmpeg = None
+    if transcode or loudness:
+        ffmpeg = find_ffmpeg()
+        if ffmpeg == None:
+            raise ValueError("ffmpeg not found. Install it or run 'spotdl --download-ffmpeg'")
+    if (tags or loudness) and importlib.util.find_spec("mutagen") == None:
+        raise ValueError("Writing tags needs mutagen (pip install mutagen)")
+    return {"tags": tags, "transcode": transcode, "loudness": loudness, "ffmpeg": ffmpeg}
+
+
+def run_ffmpeg(ffmpeg, args):
+    import subprocess
+    proc = subprocess.run([ffmpeg, "-nostdin", "-hide_banner"] + args, capture_output=True, text=True, errors="replace")
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        raise RuntimeError(f"ffmpeg failed: {lines[-1] if lines else proc.returncode}")
+    return proc.stderr
+
+
+# Converts a file to another format next to it and removes the original. Returns the new path
+def transcode_file(ffmpeg, path, audio_format):
+    stem, ext = os.path.splitext(path)
+    if ext.lower() == "." + audio_format:
+        return path
+    target = f"{stem}.{audio_format}"
+    # Written under a temporary name (keeping the extension so ffmpeg picks the format) until it's complete
+    partial = f"{stem}.part.{audio_format}"
+    try:
+        run_ffmpeg(ffmpeg, ["-v", "error", "-y", "-i", path, "-map", "0:a", "-map_metadata", "0"] + TRANSCODE_ARGS + [partial])
+        os.replace(partial, target)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    os.remove(path)
+    return target
+
+
+# Integrated loudness (LUFS) and true peak (linear) of a file, using ffmpeg's EBU R128 loudnorm filter
+def measure_loudness(ffmpeg, path):
+    output = run_ffmpeg(ffmpeg, ["-i", path, "-map", "0:a", "-af", "loudnorm=print_format=json", "-f", "null", "-"])
+    stats = json.loads(output[output.rindex("{"):])
+    return float(stats["input_i"]), 10 ** (float(stats["input_tp"]) / 20)
+
+
+# Standard fields for our tag names. Anything else (ReplayGain) goes into the user-defined
+# fields players read it from: TXXX frames in ID3 and iTunes freeform atoms in MP4
+ID3_FRAMES = {"title": "TIT2", "artist": "TPE1", "album": "TALB", "website": "WOAS"}
+MP4_KEYS = {"title": "\xa9nam", "artist": "\xa9ART", "album": "\xa9alb"}
+
+
+# Writes tags to an ID3 (mp3, wav), MP4 (m4a) or Vorbis comment (flac, ogg, opus) file.
+# Returns the names of the tags the file's format can't hold
+def write_tags(path, tags):
+    import mutagen
+    from mutagen.id3 import ID3, TXXX, Frames
+    from mutagen.mp4 import MP4, MP4FreeForm
+    from mutagen._vorbis import VCommentDict
+    audio = mutagen.File(path)
+    if audio == None:
+        raise ValueError(f"Can't write tags to {os.path.basename(path)}")
+    if audio.tags == None:
+        audio.add_tags()
+
+    unwritten = []
+    for key, value in tags.items():
+        if isinstance(audio.tags, ID3):
+            frame = ID3_FRAMES.get(key)
+            if frame == "WOAS":
+                audio.tags.setall(frame, [Frames[frame](url=value)])
+            elif frame != None:
+                audio.tags.setall(frame, [Frames[frame](encoding=3, text=[value])])
+            else:
+                audio.tags.setall(f"TXXX:{key.upper()}", [TXXX(encoding=3, desc=key.upper(), text=[value])])
+        elif isinstance(audio, MP4):
+            if key in MP4_KEYS:
+                audio.tags[MP4_KEYS[key]] = [value]
+            else:
+                audio.tags[f"----:com.apple.iTunes:{key.upper()}"] = [MP4FreeForm(value.encode("utf-8"))]
+        elif isinstance(audio.tags, VCommentDict):
+            audio.tags[key.upper()] = [value]
+        else:
+            unwritten.append(key)
+    if len(unwritten) < len(tags):
+        audio.save()
+    return unwritten
+
+
+# Post-processing of one downloaded file, runs in a worker process of run_import's process pool.
+# Optionally transcodes, then measures loudness and writes the Spotify metadata and ReplayGain tags.
+def process_audio_file(path, tags, options):
+    start = time.perf_counter()
+    info = {"path": path, "loudness": None, "replaygain": None, "unwritten_tags": []}
+    if options["transcode"]:
+        path = info["path"] = transcode_file(options["ffmpeg"], path, options["transcode"])
+
+    new_tags = dict(tags) if options["tags"] else {}
+    if options["loudness"]:
+        loudness, peak = measure_loudness(options["ffmpeg"], path)
+        info["loudness"] = loudness
+        # Silent files have no loudness to correct
+        if math.isfinite(loudness):
+            info["replaygain"] = REPLAYGAIN_REFERENCE - loudness
+            new_tags["replaygain_track_gain"] = f"{info['replaygain']:.2f} dB"
+            new_tags["replaygain_track_peak"] = f"{peak:.6f}"
+    if new_tags:
+        info["unwritten_tags"] = write_tags(path, new_tags)
+
+    info["seconds"] = time.perf_counter() - start
+    return info
+
+
 # Function that displays the main menu
 def search_song():
     clear_screen()
@@ -211,6 +1243,210 @@ def import_menu():
     import_choice = input("\nWould you like to continue?[y/N]: ")
     return import_choice
 
+# Append-only job manifest. Every state change of an import entry (pending, resolved,
+# downloaded, failed) is written as one json line so a rerun can pick up where it stopped.
+# Only a digest of each song and the offset of its last line are kept in memory, the entry
+# itself is read back from the file when asked for, so big imports don't fill memory.
+class ImportManifest:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        lines = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                lines = self.load(f)
+        # Compact the manifest once reruns have made it mostly history
+        if lines > 2 * len(self.entries) + 1000:
+            self.compact()
+        self.file = open(path, 'ab')
+        self.reader = open(path, 'rb')
+
+    # Indexes the last line of every song, returns the number of lines read
+    def load(self, f):
+        lines = 0
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            try:
+                self.entries[search_digest(*json.loads(line)["key"], normalized=True)] = offset
+                lines += 1
+            except (ValueError, KeyError, TypeError):
+                # Partially written last line from a crash
+                continue
+        return lines
+
+    def compact(self):
+        temp_path = self.path + ".tmp"
+        with open(self.path, 'rb') as source, open(temp_path, 'wb') as f:
+            for offset in sorted(self.entries.values()):
+                source.seek(offset)
+                f.write(source.readline().rstrip(b"\n") + b"\n")
+        os.replace(temp_path, self.path)
+        self.entries = {}
+        with open(self.path, 'rb') as f:
+            self.load(f)
+
+    def read(self, offset):
+        self.reader.seek(offset)
+        return json.loads(self.reader.readline())
+
+    # Last recorded entry for a song or None
+    def get(self, song_name, artist_name):
+        with self.lock:
+            offset = self.entries.get(search_digest(song_name, artist_name))
+            return self.read(offset) if offset != None else None
+
+    def record(self, song_name, artist_name, state, track=None, error=None):
+        key = normalize_search(song_name, artist_name)
+        digest = search_digest(song_name, artist_name)
+        entry = {"key": list(key), "state": state, "time": time.time()}
+        with self.lock:
+            previous = self.entries.get(digest)
+            # Keep the resolved track around for later states
+            if track == None and previous != None:
+                track = self.read(previous).get("track")
+            if track != None:
+                entry["track"] = track
+            if error != None:
+                entry["error"] = error
+            self.entries[digest] = self.file.seek(0, os.SEEK_END)
+            self.file.write(json.dumps(entry).encode("utf-8") + b"\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.reader.close()
+
+
+# Persistent index of the artist/album tree made by create_song_folder_structure, stored in
+# SQLite in the download folder. Maps Spotify track ids and normalized artist/album/title
+# to the file's path, size and mtime so "is this downloaded?" is one indexed lookup.
+# Built with a parallel os.scandir walk and updated after each download.
+class LibraryIndex:
+    def __init__(self, root, rebuild=False):
+        import sqlite3
+        self.root = root
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, LIBRARY_INDEX_FILE), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                track_id TEXT,
+                song_key TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_track_id ON files (track_id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_song_key ON files (song_key)")
+        self.conn.commit()
+        empty = self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone() == None
+        if rebuild or empty:
+            self.rebuild()
+
+    # Songs are matched on folder names and the "Artist - Title" file name spotDL writes,
+    # ignoring case and punctuation
+    def file_key(self, artist_folder, album_folder, file_stem):
+        return "\x1f".join((artist_folder.casefold(), album_folder.casefold(), re.sub(r'\W+', '', file_stem.casefold())))
+
+    def track_key(self, track):
+        return self.file_key(sanitize_filename(track["artist"]), sanitize_filename(track["album"]),
+                             f"{track['artist']} - {track['name']}")
+
+    # Rows for the audio files in one album folder
+    def scan_album(self, artist_folder, album_path):
+        rows = []
+        try:
+            entries = list(os.scandir(album_path))
+        except OSError:
+            return rows
+        album_folder = os.path.basename(album_path)
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext.lower() not in AUDIO_EXTENSIONS:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            rows.append((entry.path, None, self.file_key(artist_folder, album_folder, stem), stat.st_size, stat.st_mtime))
+        return rows
+
+    def scan_artist(self, artist_path):
+        rows = []
+        try:
+            albums = [e for e in os.scandir(artist_path) if e.is_dir()]
+        except OSError:
+            return rows
+        artist_folder = os.path.basename(artist_path)
+        for album in albums:
+            rows.extend(self.scan_album(artist_folder, album.path))
+        return rows
+
+    # Walks the whole tree again, one artist folder per thread. Keeps the track ids already known
+    def rebuild(self, workers=LIBRARY_SCAN_WORKERS):
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            artists = [e.path for e in os.scandir(self.root) if e.is_dir()]
+        except OSError:
+            artists = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            scanned = list(pool.map(self.scan_artist, artists))
+        with self.lock:
+            track_ids = dict(self.conn.execute("SELECT path, track_id FROM files WHERE track_id IS NOT NULL"))
+            self.conn.execute("DELETE FROM files")
+            for rows in scanned:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO files (path, track_id, song_key, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                    [(row[0], track_ids.get(row[0])) + row[2:] for row in rows])
+            self.conn.commit()
+
+    # Record the files in a folder after a download. Files matching one of the
+    # downloaded tracks get its Spotify id
+    def update_folder(self, folder, tracks=()):
+        artist_folder = os.path.basename(os.path.dirname(folder))
+        rows = self.scan_album(artist_folder, folder)
+        ids_by_key = {self.track_key(track): track.get("id") for track in tracks}
+        with self.lock:
+            for path, _, song_key, size, mtime in rows:
+                track_id = ids_by_key.get(song_key)
+                self.conn.execute(
+                    "INSERT INTO files (path, track_id, song_key, size, mtime) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (path) DO UPDATE SET track_id = COALESCE(excluded.track_id, track_id), "
+                    "song_key = excluded.song_key, size = excluded.size, mtime = excluded.mtime",
+                    (path, track_id, song_key, size, mtime))
+            self.conn.commit()
+
+    # Path of the downloaded file for a track or None
+    def find_track(self, track):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM files WHERE track_id = ? OR song_key = ?",
+                (track.get("id"), self.track_key(track))).fetchall()
+        for (path,) in rows:
+            if os.path.exists(path):
+                return path
+            # File was deleted (or replaced by a transcoded one) since it was indexed
+            self.remove(path)
+        return None
+
+    def remove(self, path):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.conn.commit()
+
+    def has_track(self, track):
+        return self.find_track(track) != None
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
 # Imports and parses json file and returns to download each song specified
 def parse_json_file(file_path):
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -218,6 +1454,1299 @@ def parse_json_file(file_path):
     return data['download_path'], [(s['song_name'], s['artist_name']) for s in data['songs']]
 
 
+# Reads a json document a piece at a time so values can be decoded one by one
+class JsonStream:
+    def __init__(self, f, read_size=IMPORT_READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        # Drop what has already been parsed so the buffer stays small
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(self.read_size)
+        if not chunk:
+            self.eof = True
+        self.buf += chunk
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self.read_more()
+
+    def expect(self, chars):
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(f"Invalid import file: expected {' or '.join(repr(c) for c in chars)}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number could continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+# Yields ("download_path", path) and ("song", entry) pairs from an import file as they are read.
+# Handles the normal {"download_path": ..., "songs": [...]} format and JSON Lines.
+def iter_import_events(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        if file_path.endswith(".jsonl"):
+            # One object per line, a line with "download_path" sets the folder
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                if "download_path" in entry:
+                    yield "download_path", entry["download_path"]
+                else:
+                    yield "song", entry
+            return
+
+        stream = JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "songs":
+                stream.expect("[")
+                if stream.peek() != "]":
+                    while True:
+                        yield "song", stream.value()
+                        if stream.expect(",]") == "]":
+                            break
+                else:
+                    stream.expect("]")
+            elif key == "download_path":
+                yield "download_path", stream.value()
+            else:
+                stream.value()
+            if stream.expect(",}") == "}":
+                break
+
+
+# Streaming version of parse_json_file. Returns the download path and a generator of
+# (song_name, artist_name) so songs can be worked on while the rest of the file is still being read.
+def iter_import_file(file_path):
+    events = iter_import_events(file_path)
+    download_path = None
+    kind, value = next(events, (None, None))
+    if kind == "download_path":
+        download_path = value
+    elif kind == "song":
+        # Songs are listed before the download path. Find the path first, then read the songs again
+        events.close()
+        for kind, value in iter_import_events(file_path):
+            if kind == "download_path":
+                download_path = value
+                break
+        events = iter_import_events(file_path)
+
+    if download_path == None:
+        raise KeyError('download_path')
+
+    # Songs to search for are (song_name, artist_name), Spotify links and ids are passed on as strings.
+    # Entries are checked here since they're read while the import already runs
+    def songs():
+        for kind, value in events:
+            if kind != "song":
+                continue
+            if isinstance(value, str):
+                yield value
+            elif not isinstance(value, dict):
+                raise ValueError(f"Invalid import file: song entry {value!r} is not an object or a link")
+            elif 'url' in value or 'track_id' in value:
+                link = value['url'] if 'url' in value else value['track_id']
+                if not isinstance(link, str):
+                    raise ValueError(f"Invalid import file: link in song entry {value!r} is not a string")
+                yield link
+            elif isinstance(value.get('song_name'), str) and isinstance(value.get('artist_name'), str):
+                yield value['song_name'], value['artist_name']
+            else:
+                raise ValueError(f"Invalid import file: song entry {value!r} needs a song_name and artist_name")
+
+    return download_path, songs()
+
+
+# Reads every song of an import file (json or JSON Lines) for the watch and shard queues,
+# which only hold songs to search for. Spotify links and ids are rejected as a whole file
+def read_queue_file(file_path):
+    download_path, songs = iter_import_file(file_path)
+    queued = []
+    for song in songs:
+        if isinstance(song, str):
+            raise ValueError(f"Spotify links and track ids can't be queued ({song}), import the file instead")
+        queued.append(song)
+    return download_path, queued
+
+
+# Parses sizes like "50M" or "1.5G" (bytes, powers of 1024). Used for --max-bandwidth
+def parse_size(text):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', str(text).lower())
+    if match == None:
+        raise ValueError(f"Invalid size '{text}' (examples: 500K, 50M, 1G)")
+    return int(float(match.group(1)) * 1024 ** " kmgt".index(match.group(2) or " "))
+
+
+# Queue between the search and download stages of run_import.
+# Songs come out shortest first (duration_ms from the search) so the finished count climbs fast,
+# together with other queued songs for the same artist/album folder so they share a spotDL process.
+# With max_bandwidth set, the number of downloads running at once is moved up or down to keep
+# the rate files are written at (measured over BANDWIDTH_WINDOW seconds) under the cap.
+class DownloadScheduler:
+    def __init__(self, max_workers, maxsize, batch_size=1, max_bandwidth=None):
+        self.max_workers = max_workers
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.max_bandwidth = max_bandwidth
+        # Start with one download and grow towards the cap
+        self.limit = 1 if max_bandwidth else max_workers
+        self.heap = []
+        self.active = 0
+        self.finished = 0
+        self.closed = False
+        # (time, total bytes written) after each download, for the bandwidth estimate
+        self.samples = collections.deque([(time.monotonic(), self.bytes_written())])
+        self.last_cut = 0.0
+        self.cond = threading.Condition()
+
+    def bytes_written(self):
+        with metrics.lock:
+            return metrics.counters.get("bytes_written", 0)
+
+    # Adds a song, blocks while the queue is full
+    def put(self, result):
+        duration = result["duration_ms"] if result["duration_ms"] != None else float("inf")
+        with self.cond:
+            while len(self.heap) >= self.maxsize and not self.closed:
+                self.cond.wait()
+            heapq.heappush(self.heap, (duration, result["index"], result))
+            self.cond.notify_all()
+
+    # No more songs are coming, workers stop once the queue is empty
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # Waits for a free download slot and returns the next batch of songs, None when done
+    def get_batch(self):
+        with self.cond:
+            while not self.heap or self.active >= self.limit:
+                if self.closed and not self.heap:
+                    return None
+                self.cond.wait()
+            _, _, first = heapq.heappop(self.heap)
+            batch = [first]
+            if self.batch_size > 1:
+                folder = (sanitize_filename(first["artist"]), sanitize_filename(first["album"]))
+                same_folder = [item for item in self.heap
+                               if (sanitize_filename(item[2]["artist"]), sanitize_filename(item[2]["album"])) == folder]
+                same_folder = sorted(same_folder)[:self.batch_size - 1]
+                if same_folder:
+                    taken = {id(item) for item in same_folder}
+                    self.heap = [item for item in self.heap if id(item) not in taken]
+                    heapq.heapify(self.heap)
+                    batch.extend(item[2] for item in same_folder)
+            self.active += 1
+            self.cond.notify_all()
+            return batch
+
+    # A batch finished downloading
+    def done(self, count):
+        with self.cond:
+            self.active -= 1
+            self.finished += count
+            now = time.monotonic()
+            self.samples.append((now, self.bytes_written()))
+            while len(self.samples) > 2 and now - self.samples[1][0] > BANDWIDTH_WINDOW:
+                self.samples.popleft()
+            self.adjust()
+            self.cond.notify_all()
+
+    # Bytes per second written over the last BANDWIDTH_WINDOW seconds
+    def bandwidth(self):
+        (start, start_bytes), (end, end_bytes) = self.samples[0], self.samples[-1]
+        if end - start <= 0:
+            return 0.0
+        return (end_bytes - start_bytes) / (end - start)
+
+    # AIMD: one more download while well under the cap, half as many once over it. The estimate
+    # lags by up to a window, so the limit is halved at most once per BANDWIDTH_WINDOW
+    def adjust(self):
+        if not self.max_bandwidth:
+            return
+        rate = self.bandwidth()
+        now = time.monotonic()
+        if rate > self.max_bandwidth:
+            if self.limit > 1 and now - self.last_cut >= BANDWIDTH_WINDOW:
+                self.limit = max(1, self.limit // 2)
+                self.last_cut = now
+        elif rate < self.max_bandwidth * 0.8 and self.limit < self.max_workers:
+            self.limit += 1
+
+    # Current queue state, for showing while a batch runs
+    def snapshot(self, upcoming=5):
+        with self.cond:
+            return {
+                "queued": len(self.heap),
+                "active": self.active,
+                "limit": self.limit,
+                "max_workers": self.max_workers,
+                "finished": self.finished,
+                "bandwidth": round(self.bandwidth()),
+                "max_bandwidth": self.max_bandwidth,
+                "next": [f"{item[2]['song']} - {item[2]['artist']}" for item in heapq.nsmallest(upcoming, self.heap)],
+            }
+
+
+# Statuses of songs that need nothing more
+IMPORT_OK_STATUSES = ("downloaded", "skipped", "duplicate")
+
+
+# What run_import returns: the number of songs per status and only the songs that need a look,
+# those not downloaded and those downloaded but not post-processed. Successful songs aren't
+# kept so memory doesn't grow with the size of the import
+class ImportResults:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.problems = []
+        self.post_problems = []
+
+    def add(self, result):
+        with self.lock:
+            self.counts[result["status"]] = self.counts.get(result["status"], 0) + 1
+            if result["status"] not in IMPORT_OK_STATUSES:
+                self.problems.append(result)
+
+    def add_post_problem(self, result):
+        with self.lock:
+            self.post_problems.append(result)
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+# Runs a file import as a pipeline. Songs are (song_name, artist_name) or Spotify links/ids
+# (see expand_import_entries). Songs are searched concurrently and fed through a
+# bounded DownloadScheduler to parallel spotDL download workers. The queue blocks the search
+# side when downloads fall behind so searching can't run far ahead. With postprocess options
+# (see postprocess_options) every downloaded file then goes to a process pool for tagging,
+# transcoding and loudness while the other downloads continue. On POSIX, sending the
+# process SIGUSR1 prints the queue state to stderr. on_result is called with every song's
+# result dict once it's final (from the worker threads).
+# With resume, progress is written to a manifest in the download folder and songs
+# that are already downloaded are skipped.
+# folder_lease(folder) is called before spotDL writes into a folder, to wait for other processes
+# writing there, and returns the function that releases the folder again.
+# Timings and counters are added to metrics, call metrics.reset() first to measure one import.
+# Returns an ImportResults with the count per status and the result dicts of the songs that need a look.
+def run_import(token_manager, download_path, songs, search_workers=SEARCH_WORKERS, download_workers=DOWNLOAD_WORKERS, queue_size=None, batch_size=DOWNLOAD_BATCH_SIZE, search_cache=None, resume=True, rebuild_index=False, max_bandwidth=None, postprocess=None, post_workers=POSTPROCESS_WORKERS, on_result=None, folder_lease=None):
+    import signal
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+    search_workers = max(1, search_workers)
+    download_workers = max(1, download_workers)
+    batch_size = max(1, batch_size)
+    if queue_size == None:
+        queue_size = download_workers * max(2, batch_size)
+
+    dest_path = set_folder(download_path)
+    download_queue = DownloadScheduler(download_workers, queue_size, batch_size, max_bandwidth)
+    results = ImportResults()
+
+    manifest = None
+    library = None
+    if resume:
+        manifest = ImportManifest(os.path.join(dest_path, MANIFEST_FILE))
+        library = LibraryIndex(dest_path, rebuild=rebuild_index)
+
+    # Songs on the review list from earlier imports, taken off once they get downloaded
+    review_path = os.path.join(dest_path, REVIEW_FILE)
+    review_keys = set()
+    for entry in load_review_file(review_path):
+        review_keys.update(review_entry_keys(entry))
+    reviewed = set()
+    reviewed_lock = threading.Lock()
+    refresh = search_cache != None and search_cache.refresh
+
+    def add_result(result):
+        metrics.count("tracks_" + result["status"])
+        results.add(result)
+        if review_keys and result["status"] in ("downloaded", "skipped"):
+            with reviewed_lock:
+                reviewed.update(review_keys & review_result_keys(result))
+        if on_result != None:
+            on_result(result)
+
+    def record(result, state, track=None):
+        if manifest != None:
+            manifest.record(result["song_name"], result["artist_name"], state, track, result["error"])
+
+    def new_result(index, song_name, artist_name):
+        return {
+            "index": index,
+            "song_name": song_name,
+            "artist_name": artist_name,
+            "status": "pending",
+            "artist": None,
+            "album": None,
+            "song": None,
+            "url": None,
+            "track_id": None,
+            "duration_ms": None,
+            "score": None,
+            "duplicate_of": None,
+            "error": None,
+            "file": None,
+            "replaygain": None,
+            "post_error": None,
+        }
+
+    # Fill in a found track and check whether it's already downloaded
+    def accept_track(result, track):
+        result.update(status="resolved", artist=track["artist"], album=track["album"], song=track["name"],
+                      url=track["url"], track_id=track["id"], duration_ms=track["duration_ms"],
+                      score=track.get("score"))
+
+        # Already on disk, no need to start spotDL
+        if library != None and library.has_track(track):
+            result["status"] = "skipped"
+            record(result, "downloaded")
+        # Probably the wrong song, leave it to the user
+        elif not is_confident(track):
+            result["status"] = "review"
+            result["error"] = f"Uncertain match '{track['name']}' by {track['artist']} (score {track['score']:.2f})"
+            record(result, "review", track)
+        return result
+
+    # Search stage
+    def resolve(index, song_name, artist_name):
+        result = new_result(index, song_name, artist_name)
+        # Reuse the track from an earlier run if it was already found, unless searches are refreshed
+        entry = manifest.get(song_name, artist_name) if manifest != None and not refresh else None
+        if entry != None and entry.get("track") != None:
+            track = entry["track"]
+        else:
+            record(result, "pending")
+            try:
+                track = find_spotify_track(token_manager, song_name, artist_name, search_cache)
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = f"Search error: {e}"
+                record(result, "failed")
+                return result
+            if track == None:
+                result["status"] = "not_found"
+                result["error"] = "No matching track found"
+                record(result, "failed")
+                return result
+            record(result, "resolved", track)
+        return accept_track(result, track)
+
+    # Tracks from links and ids were already looked up in bulk
+    def resolve_known(index, track):
+        if "error" in track:
+            result = new_result(index, track["entry"], "")
+            result["status"] = "failed"
+            result["error"] = track["error"]
+            record(result, "failed")
+            return result
+        result = new_result(index, track["name"], track["artist"])
+        record(result, "resolved", track)
+        return accept_track(result, track)
+
+    # Only one spotDL process writes to a folder at a time
+    folder_locks = {}
+    folder_locks_lock = threading.Lock()
+
+    def folder_lock(folder):
+        with folder_locks_lock:
+            return folder_locks.setdefault(folder, threading.Lock())
+
+    # Locks a folder for this import and, with folder_lease, for other nodes too. Returns the unlock function
+    def lock_folder(folder):
+        lock = folder_lock(folder)
+        lock.acquire()
+        if folder_lease == None:
+            return lock.release
+        try:
+            release_lease = folder_lease(folder)
+        except BaseException:
+            lock.release()
+            raise
+
+        def unlock():
+            try:
+                release_lease()
+            finally:
+                lock.release()
+        return unlock
+
+    # Download a batch of songs, one spotDL process per destination folder.
+    # The index of every song that was passed on to add_result goes in reported
+    def download_batch(batch, reported):
+        def report(result):
+            reported.add(result["index"])
+            add_result(result)
+
+        groups = {}
+        for result in batch:
+            try:
+                song_path = create_song_folder_structure(dest_path, result["artist"], result["album"], result["song"])
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = f"Download error: {e}"
+                report(result)
+                continue
+            groups.setdefault(song_path, []).append(result)
+
+        for song_path, group in groups.items():
+            outcome = {}
+            unlock = lock_folder(song_path)
+            try:
+                try:
+                    outcome = download_spotify_urls([r["url"] for r in group], song_path,
+                                                    {r["url"]: (r["artist"], r["song"]) for r in group})
+                except Exception as e:
+                    for result in group:
+                        result["error"] = f"Download error: {e}"
+                downloaded = [r for r in group if outcome.get(r["url"])]
+                # Indexed before the folder is unlocked, so no other spotDL process is halfway through a file there
+                if library != None:
+                    library.update_folder(song_path, [
+                        {"artist": r["artist"], "album": r["album"], "name": r["song"], "id": r["track_id"]}
+                        for r in downloaded])
+            except BaseException:
+                unlock()
+                raise
+            if post_pool != None and downloaded:
+                postprocess_folder(song_path, downloaded, unlock)
+            else:
+                unlock()
+            for result in group:
+                if outcome.get(result["url"]):
+                    result["status"] = "downloaded"
+                    record(result, "downloaded")
+                else:
+                    result["status"] = "failed"
+                    result["error"] = result["error"] or "spotDL download failed"
+                    record(result, "failed")
+                report(result)
+
+    def postprocess_failed(result, error):
+        result["post_error"] = error
+        metrics.count("postprocess_failed")
+        results.add_post_problem(result)
+
+    # Post-processing stage. The folder stays locked until its files are done so
+    # no spotDL process writes there while they are being rewritten
+    def postprocess_folder(folder, group, unlock):
+        jobs = []
+        for result in group:
+            path = find_song_file(folder, result["artist"], result["song"])
+            if path == None:
+                postprocess_failed(result, "Downloaded file not found")
+            else:
+                jobs.append((result, path))
+        remaining = [len(jobs)]
+        remaining_lock = threading.Lock()
+
+        def finished(result, path, future):
+            try:
+                info = future.result()
+                metrics.record("postprocess", info["seconds"])
+                result.update(file=info["path"], replaygain=info["replaygain"])
+                if info["unwritten_tags"]:
+                    postprocess_failed(result, f"Can't write {', '.join(info['unwritten_tags'])} tags to {os.path.basename(info['path'])}")
+                else:
+                    metrics.count("postprocessed")
+                # Transcoded to a new file
+                if library != None and info["path"] != path:
+                    library.remove(path)
+                    library.update_folder(folder, [
+                        {"artist": result["artist"], "album": result["album"], "name": result["song"], "id": result["track_id"]}])
+            except Exception as e:
+                postprocess_failed(result, f"Post-processing error: {e}")
+            finally:
+                with remaining_lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    unlock()
+
+        if not jobs:
+            unlock()
+            return
+        for result, path in jobs:
+            result["file"] = path
+            tags = {"title": result["song"], "artist": result["artist"], "album": result["album"], "website": result["url"]}
+            try:
+                future = post_pool.submit(process_audio_file, path, tags, postprocess)
+            except Exception as e:
+                # Pool broke or was shut down, count the job as done
+                future = Future()
+                future.set_exception(e)
+            future.add_done_callback(lambda f, result=result, path=path: finished(result, path, f))
+
+    # Download stage. The scheduler decides what is downloaded next and how many run at once
+    def download_worker():
+        while True:
+            batch = download_queue.get_batch()
+            if batch == None:
+                break
+            reported = set()
+            try:
+                download_batch(batch, reported)
+            except Exception as e:
+                # A manifest, library index or on_result error (full disk, locked database) fails the
+                # rest of the batch. Ending the thread would leave put() waiting for it forever
+                print(f"Download error: {e}", file=sys.stderr)
+                for result in batch:
+                    if result["index"] in reported:
+                        continue
+                    reported.add(result["index"])
+                    result["status"] = "failed"
+                    result["error"] = f"Download error: {e}"
+                    try:
+                        add_result(result)
+                    except Exception:
+                        # Already counted, only on_result failed again
+                        pass
+            finally:
+                download_queue.done(len(batch))
+
+    def print_queue_state(signum, frame):
+        print(json.dumps(download_queue.snapshot()), file=sys.stderr)
+
+    # Resolved songs go on to the download queue, put() blocks while the queue is full
+    def handle_result(result):
+        # Different entries that turned out to be the same track
+        if result["status"] in ("resolved", "skipped"):
+            track_key = result["track_id"] or result["url"]
+            if track_key in seen_tracks:
+                result["status"] = "duplicate"
+                result["duplicate_of"] = seen_tracks[track_key]
+                add_result(result)
+                return
+            seen_tracks[track_key] = result["index"]
+        if result["status"] == "resolved":
+            download_queue.put(result)
+        else:
+            add_result(result)
+
+    def handle_resolved(futures):
+        for future in futures:
+            handle_result(future.result())
+
+    # Dedup stage: first index of every normalized search (as its digest) and of every resolved track
+    seen_searches = {}
+    seen_tracks = {}
+
+    post_pool = None
+    if postprocess != None:
+        post_pool = ProcessPoolExecutor(max_workers=post_workers or os.cpu_count())
+        # Start the worker processes now, before the download threads exist, so they
+        # aren't forked while other threads hold locks
+        post_pool.submit(os.getpid).result()
+
+    workers = [threading.Thread(target=download_worker, daemon=True) for _ in range(download_workers)]
+    for worker in workers:
+        worker.start()
+
+    previous_handler = None
+    try:
+        previous_handler = signal.signal(signal.SIGUSR1, print_queue_state)
+    except (AttributeError, ValueError):
+        # No SIGUSR1 on Windows, and handlers can only be set from the main thread
+        pass
+
+    try:
+        with ThreadPoolExecutor(max_workers=search_workers) as pool:
+            pending = set()
+            for index, entry in enumerate(expand_import_entries(token_manager, songs)):
+                if not isinstance(entry, tuple):
+                    handle_result(resolve_known(index, entry))
+                    continue
+                song_name, artist_name = entry
+                search_key = search_digest(song_name, artist_name)
+                if search_key in seen_searches:
+                    result = new_result(index, song_name, artist_name)
+                    result["status"] = "duplicate"
+                    result["duplicate_of"] = seen_searches[search_key]
+                    add_result(result)
+                    continue
+                seen_searches[search_key] = index
+                pending.add(pool.submit(resolve, index, song_name, artist_name))
+                # Keep only a couple of searches per worker in flight
+                if len(pending) >= search_workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    handle_resolved(done)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                handle_resolved(done)
+    finally:
+        download_queue.close()
+        for worker in workers:
+            worker.join()
+        if post_pool != None:
+            post_pool.shutdown(wait=True)
+        if previous_handler != None:
+            signal.signal(signal.SIGUSR1, previous_handler)
+        if manifest != None:
+            manifest.close()
+        if library != None:
+            library.close()
+
+    results.problems.sort(key=lambda r: r["index"])
+    results.post_problems.sort(key=lambda r: r["index"])
+    update_review_file(review_path, dest_path, [r for r in results.problems if r["status"] == "review"], reviewed)
+    return results
+
+
+# Entries of a review file, empty when there is none (or it can't be read)
+def load_review_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            songs = json.load(f).get("songs", [])
+    except (OSError, ValueError, AttributeError):
+        return []
+    return [song for song in songs if isinstance(song, dict) and "song_name" in song and "artist_name" in song]
+
+
+# What a review entry is recognized by: its normalized search and the links in it
+def review_entry_keys(entry):
+    keys = {normalize_search(entry["song_name"], entry["artist_name"])}
+    for url in (entry.get("url"), (entry.get("match") or {}).get("url")):
+        if url:
+            keys.add(url)
+    return keys
+
+
+def review_result_keys(result):
+    keys = {normalize_search(result["song_name"], result["artist_name"])}
+    if result["url"]:
+        keys.add(result["url"])
+    return keys
+
+
+# Keeps the songs that need a look in the download folder, in the import file format. Adding "url"
+# to an entry (the match's or the right song's link) and importing the file downloads it.
+# New entries are merged into the file, entries matching one of the resolved keys (songs that
+# have been downloaded since) are taken off. Other imports into the folder, from watch mode or
+# other workers, may update the file too, so it's read again and replaced in one go under a lock
+def update_review_file(path, download_path, results, resolved=()):
+    if not results and not resolved:
+        return
+    with review_file_lock(path):
+        entries = {}
+        for entry in load_review_file(path):
+            if not review_entry_keys(entry) & set(resolved):
+                entries[normalize_search(entry["song_name"], entry["artist_name"])] = entry
+        for r in results:
+            entries[normalize_search(r["song_name"], r["artist_name"])] = {
+                "song_name": r["song_name"],
+                "artist_name": r["artist_name"],
+                "match": {"name": r["song"], "artist": r["artist"], "album": r["album"], "url": r["url"], "score": r["score"]},
+            }
+        # Every song on the list was downloaded
+        if not entries:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        partial = f"{path}.{os.getpid()}.tmp"
+        with open(partial, "w", encoding="utf-8") as f:
+            json.dump({"download_path": download_path, "songs": list(entries.values())}, f, indent=4, ensure_ascii=False)
+        os.replace(partial, path)
+
+
+_review_lock = threading.Lock()
+
+
+# Holds the review file for one update, across processes where fcntl is available (not on Windows)
+@contextlib.contextmanager
+def review_file_lock(path):
+    with _review_lock:
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        lock_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.lock")
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Prints the results of a file import
+def print_import_summary(results):
+    counts = results.counts
+
+    print(f"\n{results.total()} songs processed.")
+    for status in sorted(counts):
+        print(f"  {status}: {counts[status]}")
+
+    if counts.get("duplicate"):
+        print(f"\n{counts['duplicate']} duplicates removed.")
+    if counts.get("review"):
+        print(f"\n{counts['review']} uncertain matches were not downloaded, see {REVIEW_FILE} in the download folder.")
+
+    if results.problems:
+        print("\nNot downloaded:")
+        for result in results.problems:
+            reason = result["error"] or "No matching track found"
+            print(f"  - '{result['song_name']}' by '{result['artist_name']}': {reason}")
+
+    if results.post_problems:
+        print("\nDownloaded but not processed:")
+        for result in results.post_problems:
+            print(f"  - '{result['song']}' by '{result['artist']}': {result['post_error']}")
+
+
+# Persistent queue of songs for watch mode, stored in SQLite in the inbox folder.
+# A song is only queued once per download folder (compared with normalize_search), no matter
+# how many inbox files list it. Songs go pending -> active -> done, failed, not_found or review.
+class WorkQueue:
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                download_path TEXT NOT NULL,
+                song_name TEXT NOT NULL,
+                artist_name TEXT NOT NULL,
+                song_key TEXT NOT NULL,
+                artist_key TEXT NOT NULL,
+                source TEXT,
+                state TEXT NOT NULL,
+                error TEXT,
+                added REAL NOT NULL,
+                finished REAL,
+                UNIQUE (download_path, song_key, artist_key)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished)")
+        # Songs that were being imported when the last run stopped
+        self.conn.execute("UPDATE jobs SET state = 'pending' WHERE state = 'active'")
+        self.conn.commit()
+
+    # Queues the songs of one inbox file. Returns (added, already queued)
+    def add(self, download_path, songs, source=None):
+        now = time.time()
+        with self.lock:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (download_path, song_name, artist_name, song_key, artist_key, source, state, added) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)",
+                [(download_path, song_name, artist_name) + normalize_search(song_name, artist_name) + (source, now)
+                 for song_name, artist_name in songs])
+            added = self.conn.total_changes - before
+            self.conn.commit()
+        return added, len(songs) - added
+
+    # Marks up to limit pending songs of the oldest download folder active.
+    # Returns (download_path, [(id, song_name, artist_name)]), (None, []) when nothing is pending
+    def take(self, limit):
+        with self.lock:
+            row = self.conn.execute("SELECT download_path FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1").fetchone()
+            if row == None:
+                return None, []
+            jobs = self.conn.execute(
+                "SELECT id, song_name, artist_name FROM jobs WHERE state = 'pending' AND download_path = ? ORDER BY id LIMIT ?",
+                (row[0], limit)).fetchall()
+            self.conn.executemany("UPDATE jobs SET state = 'active' WHERE id = ?", [(job[0],) for job in jobs])
+            self.conn.commit()
+        return row[0], jobs
+
+    # Records (id, state, error) for finished songs
+    def finish(self, outcomes):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?",
+                                  [(state, error, now, job_id) for job_id, state, error in outcomes])
+            self.conn.commit()
+
+    # Number of songs in every state
+    def counts(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state"))
+
+    # Songs finished (in any final state) since the given time
+    def finished_since(self, since):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE finished >= ?", (since,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Serves status() as json on http://127.0.0.1:<port>/ from a background thread. Returns the server
+def start_status_server(port, status):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/status"):
+                self.send_error(404)
+                return
+            body = json.dumps(status(), indent=2).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Keep requests out of the import output
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StatusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Moves a handled inbox file into a subfolder (processed/ or failed/) without overwriting older ones
+def move_inbox_file(path, folder):
+    os.makedirs(folder, exist_ok=True)
+    name = os.path.basename(path)
+    target = os.path.join(folder, name)
+    if os.path.exists(target):
+        stem, ext = os.path.splitext(name)
+        target = os.path.join(folder, f"{stem}.{time.strftime('%Y%m%d-%H%M%S')}{ext}")
+    os.replace(path, target)
+
+
+# Watch mode. Polls the inbox folder for import files (read_queue_file format), adds their songs
+# to the WorkQueue and imports the queue WATCH_BATCH songs at a time with run_import.
+# The token, HTTP connections and search cache stay open between imports. Runs until
+# interrupted (Ctrl+C / SIGTERM), finishing the current import first.
+def run_watch(token_manager, inbox, import_options, interval=WATCH_INTERVAL, status_port=WATCH_STATUS_PORT,
+              output=None, batch=WATCH_BATCH, on_import=None):
+    import signal
+    inbox = os.path.abspath(inbox)
+    os.makedirs(inbox, exist_ok=True)
+    work_queue = WorkQueue(os.path.join(inbox, WATCH_QUEUE_FILE))
+    stop = threading.Event()
+    started = time.time()
+    state = {"current": None, "files": 0, "bad_files": 0, "imports": 0, "last_error": None}
+    import_options = dict(import_options)
+
+    def status():
+        now = time.time()
+        counts = work_queue.counts()
+        done = sum(count for name, count in counts.items() if name not in ("pending", "active"))
+        last_hour = work_queue.finished_since(now - 3600)
+        return {
+            "inbox": inbox,
+            "uptime": round(now - started, 1),
+            "state": "importing" if state["current"] else "idle",
+            "current": state["current"],
+            "queue_depth": counts.get("pending", 0) + counts.get("active", 0),
+            "queue": counts,
+            "files_ingested": state["files"],
+            "files_failed": state["bad_files"],
+            "imports": state["imports"],
+            "throughput": {
+                "finished": done,
+                "last_hour": last_hour,
+                "tracks_per_minute": round(last_hour / min(60, max((now - started) / 60, 1)), 2),
+            },
+            "last_error": state["last_error"],
+        }
+
+    # Files that couldn't be moved out of the inbox, with their mtime, so they aren't read again
+    stuck = {}
+
+    def move(path, mtime, folder):
+        try:
+            move_inbox_file(path, os.path.join(inbox, folder))
+        except OSError as e:
+            print(f"Unable to move '{path}': {e}")
+            state["last_error"] = f"Unable to move {os.path.basename(path)}: {e}"
+            stuck[path] = mtime
+
+    # Queues the inbox files that are done being written (unchanged for WATCH_SETTLE_TIME), oldest first
+    def ingest():
+        files = []
+        try:
+            for entry in os.scandir(inbox):
+                if entry.name.endswith((".json", ".jsonl")) and entry.is_file():
+                    files.append((entry.stat().st_mtime, entry.name, entry.path))
+        except OSError as e:
+            state["last_error"] = f"Unable to read inbox: {e}"
+            return
+        now = time.time()
+        for mtime, name, path in sorted(files):
+            if now - mtime < WATCH_SETTLE_TIME or stuck.get(path) == mtime:
+                continue
+            try:
+                download_path, songs = read_queue_file(path)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"Unable to read import file '{name}': {e}")
+                state["bad_files"] += 1
+                state["last_error"] = f"{name}: {e}"
+                move(path, mtime, "failed")
+                continue
+            download_path = os.path.abspath(os.path.expanduser(output or download_path))
+            added, known = work_queue.add(download_path, songs, name)
+            print(f"Queued {added} songs from '{name}' ({known} already queued).")
+            state["files"] += 1
+            move(path, mtime, "processed")
+
+    def request_stop(signum, frame):
+        print("Stopping after the current import...")
+        stop.set()
+
+    previous_handler = None
+    try:
+        previous_handler = signal.signal(signal.SIGTERM, request_stop)
+    except (AttributeError, ValueError):
+        pass
+
+    server = start_status_server(status_port, status) if status_port else None
+    if server != None:
+        print(f"Status on http://127.0.0.1:{server.server_address[1]}/")
+    print(f"Watching '{inbox}' for import files. Press Ctrl+C to stop.")
+
+    try:
+        while not stop.is_set():
+            ingest()
+            download_path, jobs = work_queue.take(batch)
+            if not jobs:
+                stop.wait(interval)
+                continue
+
+            state["current"] = {"download_path": download_path, "songs": len(jobs), "started": time.time()}
+            metrics.reset()
+            outcomes = []
+
+            def finished(result):
+                state_name = "done" if result["status"] in IMPORT_OK_STATUSES else result["status"]
+                outcomes.append((jobs[result["index"]][0], state_name, result["error"]))
+            try:
+                results = run_import(token_manager, download_path, [(job[1], job[2]) for job in jobs],
+                                     on_result=finished, **import_options)
+            except (OSError, ValueError) as e:
+                print(f"Import into '{download_path}' failed: {e}")
+                state["last_error"] = f"{download_path}: {e}"
+                work_queue.finish([(job[0], "failed", str(e)) for job in jobs])
+            else:
+                work_queue.finish(outcomes)
+                print_import_summary(results)
+                if on_import != None:
+                    on_import(results)
+            state["imports"] += 1
+            state["current"] = None
+            # Only the first import rescans the library
+            import_options["rebuild_index"] = False
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    finally:
+        if server != None:
+            server.shutdown()
+            server.server_close()
+        if previous_handler != None:
+            signal.signal(signal.SIGTERM, previous_handler)
+        work_queue.close()
+
+
+# Import queue shared by several worker processes or hosts, a SQLite file on shared storage.
+# Songs are grouped in shards by download folder and artist. A worker leases songs from one shard
+# at a time and no other worker gets songs of a shard while it has a live lease there, so two
+# nodes never download into the same artist's folders at once.
+class ShardQueue:
+    def __init__(self, path):
+        import sqlite3
+        self.lock = threading.Lock()
+        # Explicit transactions (BEGIN IMMEDIATE) and the default rollback journal: WAL needs
+        # shared memory, which network file systems don't have
+        self.conn = sqlite3.connect(path, timeout=SHARD_DB_TIMEOUT, check_same_thread=False, isolation_level=None)
+        with self.transaction():
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY,
+                    download_path TEXT NOT NULL,
+                    shard TEXT NOT NULL,
+                    song_name TEXT NOT NULL,
+                    artist_name TEXT NOT NULL,
+                    song_key TEXT NOT NULL,
+                    artist_key TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    owner TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    url TEXT,
+                    updated REAL NOT NULL,
+                    UNIQUE (download_path, song_key, artist_key)
+                )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS items_shard ON items (shard, state)")
+            # Album folders a node is downloading into. Shards go by the artist in the import file, but
+            # folders are named after the artists Spotify returns, so two shards can share a folder
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS folders (
+                    download_path TEXT NOT NULL,
+                    folder TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    lease_expires REAL NOT NULL,
+                    PRIMARY KEY (download_path, folder)
+                )""")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    # Adds the songs of an import file. Returns (added, already queued)
+    def publish(self, download_path, songs):
+        now = time.time()
+        rows = []
+        for song_name, artist_name in songs:
+            song_key, artist_key = normalize_search(song_name, artist_name)
+            rows.append((download_path, f"{download_path}\x1f{artist_key}", song_name, artist_name, song_key, artist_key, now))
+        with self.transaction():
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO items (download_path, shard, song_name, artist_name, song_key, artist_key, state, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?)", rows)
+            added = self.conn.total_changes - before
+        return added, len(rows) - added
+
+    # Queues the songs of leases nobody renewed again, or fails them after SHARD_MAX_ATTEMPTS
+    def requeue_expired(self, now):
+        self.conn.execute(
+            "UPDATE items SET state = 'failed', error = 'Lease expired ' || attempts || ' times', owner = NULL, updated = ? "
+            "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, SHARD_MAX_ATTEMPTS))
+        return self.conn.execute(
+            "UPDATE items SET state = 'pending', owner = NULL, lease_expires = NULL, updated = ? "
+            "WHERE state = 'leased' AND lease_expires < ?", (now, now)).rowcount
+
+    # Leases up to limit songs of the oldest shard no other node is working on.
+    # Returns (download_path, [(id, song_name, artist_name)]), (None, []) when there is nothing to lease
+    def lease(self, node, limit, lease_time):
+        now = time.time()
+        with self.transaction():
+            requeued = self.requeue_expired(now)
+            if requeued:
+                print(f"{requeued} songs from expired leases queued again.")
+            row = self.conn.execute(
+                "SELECT shard, download_path FROM items WHERE state = 'pending' AND shard NOT IN "
+                "(SELECT shard FROM items WHERE state = 'leased' AND owner != ?) ORDER BY id LIMIT 1", (node,)).fetchone()
+            if row == None:
+                return None, []
+            items = self.conn.execute(
+                "SELECT id, song_name, artist_name FROM items WHERE shard = ? AND state = 'pending' ORDER BY id LIMIT ?",
+                (row[0], limit)).fetchall()
+            self.conn.executemany(
+                "UPDATE items SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                [(node, now + lease_time, now, item[0]) for item in items])
+        return row[1], items
+
+    # Heartbeat, extends the node's leases on the given songs and on the folders it holds
+    def renew(self, node, ids, lease_time):
+        now = time.time()
+        with self.transaction():
+            self.conn.executemany(
+                "UPDATE items SET lease_expires = ?, updated = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                [(now + lease_time, now, item_id, node) for item_id in ids])
+            self.conn.execute("UPDATE folders SET lease_expires = ? WHERE owner = ?", (now + lease_time, node))
+
+    # Waits until no other node holds the folder (a path relative to download_path), then leases it
+    def lock_folder(self, node, download_path, folder, lease_time):
+        waiting = False
+        while True:
+            now = time.time()
+            with self.transaction():
+                self.conn.execute("DELETE FROM folders WHERE download_path = ? AND folder = ? AND lease_expires < ?",
+                                  (download_path, folder, now))
+                self.conn.execute("INSERT OR IGNORE INTO folders (download_path, folder, owner, lease_expires) VALUES (?, ?, ?, ?)",
+                                  (download_path, folder, node, now + lease_time))
+                owner = self.conn.execute("SELECT owner FROM folders WHERE download_path = ? AND folder = ?",
+                                          (download_path, folder)).fetchone()[0]
+            if owner == node:
+                return
+            if not waiting:
+                print(f"Waiting for '{owner}' to finish downloading into '{folder}'...")
+                waiting = True
+            time.sleep(SHARD_FOLDER_POLL_INTERVAL)
+
+    def unlock_folder(self, node, download_path, folder):
+        with self.transaction():
+            self.conn.execute("DELETE FROM folders WHERE download_path = ? AND folder = ? AND owner = ?",
+                              (download_path, folder, node))
+
+    # Reports (id, state, error, url) for leased songs. Songs whose lease was lost to another node are left alone
+    def finish(self, node, outcomes):
+        now = time.time()
+        with self.transaction():
+            self.conn.executemany(
+                "UPDATE items SET state = ?, error = ?, url = ?, lease_expires = NULL, updated = ? "
+                "WHERE id = ? AND owner = ? AND state = 'leased'",
+                [(state, error, url, now, item_id, node) for item_id, state, error, url in outcomes])
+
+    # Number of songs in every state
+    def counts(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state"))
+
+    # Songs per node and state
+    def nodes(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT owner, state, COUNT(*) FROM items WHERE owner IS NOT NULL GROUP BY owner, state")
+            nodes = {}
+            for owner, state, count in rows:
+                nodes.setdefault(owner, {})[state] = count
+            return nodes
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# Worker of a sharded import. Leases songs from the ShardQueue, imports them with run_import and
+# reports the results, renewing the lease in the background while the import runs. Stops when
+# the queue is done (or keeps waiting for new songs with follow), or on Ctrl+C / SIGTERM after the
+# current lease. Returns the number of songs that ended up not downloaded
+def run_shard_worker(token_manager, queue_path, import_options, node=None, batch=SHARD_BATCH,
+                     lease_time=SHARD_LEASE_TIME, follow=False, output=None, on_import=None):
+    import signal
+    import socket
+    node = node or f"{socket.gethostname()}-{os.getpid()}"
+    shard_queue = ShardQueue(queue_path)
+    stop = threading.Event()
+    failed = 0
+    # The shared queue tracks what's done, the manifest and library index files can't be shared between nodes
+    import_options = dict(import_options, resume=False)
+
+    def request_stop(signum, frame):
+        print("Stopping after the current lease...")
+        stop.set()
+
+    previous_handler = None
+    try:
+        previous_handler = signal.signal(signal.SIGTERM, request_stop)
+    except (AttributeError, ValueError):
+        pass
+
+    print(f"Worker '{node}' on queue '{queue_path}'.")
+    try:
+        while not stop.is_set():
+            download_path, items = shard_queue.lease(node, batch, lease_time)
+            if not items:
+                counts = shard_queue.counts()
+                if not follow and not counts.get("pending") and not counts.get("leased"):
+                    print("Queue is done.")
+                    break
+                stop.wait(SHARD_POLL_INTERVAL)
+                continue
+
+            print(f"Leased {len(items)} songs by '{items[0][2]}' for '{download_path}'.")
+            shared_path = download_path
+            # Where this node has the shared download folder mounted
+            if output:
+                download_path = os.path.abspath(os.path.expanduser(output))
+
+            # Album folders are locked in the queue by their path inside the download folder,
+            # which is the same on every node
+            def folder_lease(folder, local_path=download_path, shared_path=shared_path):
+                key = os.path.relpath(folder, os.path.abspath(local_path)).replace(os.sep, "/")
+                shard_queue.lock_folder(node, shared_path, key, lease_time)
+                return lambda: shard_queue.unlock_folder(node, shared_path, key)
+            ids = [item[0] for item in items]
+            lease_done = threading.Event()
+
+            def heartbeat():
+                while not lease_done.wait(lease_time / 3):
+                    try:
+                        shard_queue.renew(node, ids, lease_time)
+                    except Exception as e:
+                        print(f"Unable to renew lease: {e}")
+
+            renewer = threading.Thread(target=heartbeat, daemon=True)
+            renewer.start()
+            metrics.reset()
+            outcomes = []
+
+            def finished(result):
+                state_name = "done" if result["status"] in IMPORT_OK_STATUSES else result["status"]
+                outcomes.append((ids[result["index"]], state_name, result["error"], result["url"]))
+            try:
+                results = run_import(token_manager, download_path, [(item[1], item[2]) for item in items],
+                                     on_result=finished, folder_lease=folder_lease, **import_options)
+            except (OSError, ValueError) as e:
+                print(f"Import into '{download_path}' failed: {e}")
+                outcomes = [(item_id, "failed", str(e), None) for item_id in ids]
+            else:
+                print_import_summary(results)
+                if on_import != None:
+                    on_import(results)
+            finally:
+                lease_done.set()
+                renewer.join()
+            shard_queue.finish(node, outcomes)
+            failed += sum(1 for outcome in outcomes if outcome[1] != "done")
+    except KeyboardInterrupt:
+        print("\nStopped. Songs of the current lease are queued again once it expires.")
+    finally:
+        if previous_handler != None:
+            signal.signal(signal.SIGTERM, previous_handler)
+        shard_queue.close()
+    return failed
+
+
+# Prints the state of a sharded import
+def print_shard_status(shard_queue):
+    counts = shard_queue.counts()
+    print(f"{sum(counts.values())} songs in the queue.")
+    for state in sorted(counts):
+        print(f"  {state}: {counts[state]}")
+    nodes = shard_queue.nodes()
+    if nodes:
+        print("\nNodes:")
+        for node in sorted(nodes):
+            states = ", ".join(f"{state}: {count}" for state, count in sorted(nodes[node].items()))
+            print(f"  {node}  {states}")
+
+
 def edit_API_keys():
     clear_screen()
     print("""
@@ -281,7 +2810,282 @@ def print_download_menu():
 
 
 
+# --candidates value, Spotify's search returns at most SEARCH_MAX_CANDIDATES results
+def parse_candidates(text):
+    count = int(text)
+    if not 1 <= count <= SEARCH_MAX_CANDIDATES:
+        raise argparse.ArgumentTypeError(f"{count} is not between 1 and {SEARCH_MAX_CANDIDATES}")
+    return count
+
+
+# Command line options. Without a command the interactive menu is started
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Search and download Spotify songs using spotDL.")
+
+    # Options that go before the command (they apply to the menu too) or after it. The commands'
+    # copies have no default, so they don't overwrite a value given before the command
+    def add_global_options(target, **default):
+        target.add_argument("--no-cache", action="store_true", help="don't read or write the search cache", **default)
+        target.add_argument("--refresh", action="store_true", help="ignore cached searches and store fresh results", **default)
+        target.add_argument("--rebuild-index", action="store_true", help="rescan the download folder before skipping downloaded songs", **default)
+        target.add_argument("--metrics-json", metavar="FILE", help="write the import's timings and counters to a json file", **default)
+        target.add_argument("--metrics-prom", metavar="FILE", help="write the import's timings and counters as a Prometheus textfile", **default)
+        target.add_argument("--candidates", type=parse_candidates, metavar="N", help=f"search results scored per song, 1 to {SEARCH_MAX_CANDIDATES}, 1 takes the first hit (default: {SEARCH_CANDIDATES})", **default)
+        target.add_argument("--min-score", type=float, metavar="SCORE", help=f"matches scoring lower are put up for review instead of downloaded, 0 downloads everything (default: {MATCH_MIN_SCORE})", **default)
+
+    add_global_options(parser)
+    global_options = argparse.ArgumentParser(add_help=False)
+    add_global_options(global_options, default=argparse.SUPPRESS)
+
+    # Options shared by the commands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    download_options = argparse.ArgumentParser(add_help=False)
+    download_options.add_argument("-o", "--output", help="download folder (import: overrides download_path)")
+    download_options.add_argument("-c", "--concurrency", type=int, default=None, help="number of parallel spotDL downloads")
+    download_options.add_argument("-f", "--format", dest="audio_format", help="audio format passed to spotDL (mp3, flac, m4a, opus, ogg, wav)")
+    download_options.add_argument("--max-bandwidth", type=parse_size, metavar="RATE", help="keep downloads under RATE bytes/s, e.g. 5M")
+    download_options.add_argument("--tag", action="store_true", help="write the Spotify artist/album/title/link into the files' tags")
+    download_options.add_argument("--transcode", metavar="FORMAT", help="convert downloaded files to FORMAT with ffmpeg")
+    download_options.add_argument("--replaygain", action="store_true", help="measure loudness and write ReplayGain tags")
+    download_options.add_argument("--post-workers", type=int, default=None, help="processes used for --tag/--transcode/--replaygain (default: one per CPU)")
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    search = commands.add_parser("search", parents=[common, global_options], help="search for a song and print the match")
+    search.add_argument("song_name")
+    search.add_argument("artist_name")
+    download = commands.add_parser("download", parents=[common, global_options, download_options], help="download a song, or a Spotify track/album/playlist link")
+    download.add_argument("song_name", help="song name or Spotify link")
+    download.add_argument("artist_name", nargs="?", help="artist name (not needed for links)")
+    import_file = commands.add_parser("import", parents=[common, global_options, download_options], help="download every song in an import file")
+    import_file.add_argument("file")
+    watch = commands.add_parser("watch", parents=[common, global_options, download_options], help="keep importing the files dropped into an inbox folder")
+    watch.add_argument("inbox", help="folder to watch for import files")
+    watch.add_argument("--interval", type=float, default=WATCH_INTERVAL, help=f"seconds between inbox checks (default: {WATCH_INTERVAL})")
+    watch.add_argument("--status-port", type=int, default=WATCH_STATUS_PORT, help=f"port of the local json status page, 0 turns it off (default: {WATCH_STATUS_PORT})")
+    publish = commands.add_parser("publish", parents=[common], help="add an import file's songs to a shared queue for worker nodes")
+    publish.add_argument("file")
+    publish.add_argument("--queue", required=True, help="queue file, on storage all workers can reach")
+    publish.add_argument("-o", "--output", help="download folder as the workers see it (overrides download_path)")
+    worker = commands.add_parser("worker", parents=[common, global_options, download_options], help="download songs from a shared queue until it is done")
+    worker.add_argument("--queue", required=True, help="queue file made by publish")
+    worker.add_argument("--node", help="name of this worker in the queue (default: host-pid)")
+    worker.add_argument("--batch", type=int, default=SHARD_BATCH, help=f"songs leased at a time (default: {SHARD_BATCH})")
+    worker.add_argument("--lease", type=float, default=SHARD_LEASE_TIME, help=f"seconds before a lease of a worker that stopped responding runs out (default: {SHARD_LEASE_TIME})")
+    worker.add_argument("--follow", action="store_true", help="keep waiting for new songs when the queue is done")
+    queue_status = commands.add_parser("queue-status", help="show the progress of a shared queue")
+    queue_status.add_argument("--queue", required=True, help="queue file made by publish")
+    return parser.parse_args(argv)
+
+
+# Search options from the command line replace the defaults
+def apply_search_options(args):
+    global SEARCH_CANDIDATES, MATCH_MIN_SCORE
+    if args.candidates != None:
+        SEARCH_CANDIDATES = args.candidates
+    if args.min_score != None:
+        MATCH_MIN_SCORE = args.min_score
+
+
+# Loads the API keys from .env / the environment
+def load_credentials():
+    from dotenv import load_dotenv
+    load_dotenv(override=True)
+    return os.getenv("CLIENT_ID"), os.getenv("CLIENT_SECRET")
+
+
+# Writes the metrics of the last import to the files given on the command line
+def export_metrics(args):
+    try:
+        if args.metrics_json:
+            metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            metrics.write_prometheus(args.metrics_prom)
+    except OSError as e:
+        print(f"Unable to write metrics: {e}", file=sys.stderr)
+
+
+def open_search_cache(args, out=sys.stdout):
+    import sqlite3
+    if args.no_cache:
+        return None
+    try:
+        return SearchCache(SEARCH_CACHE_FILE, refresh=args.refresh)
+    except sqlite3.Error as e:
+        print(f"Search cache disabled: {e}", file=out)
+        return None
+
+
+# Commands that only touch the shared queue and don't need API keys
+def run_queue_command(args):
+    import sqlite3
+    if args.command == "queue-status" and not os.path.exists(args.queue):
+        print(f"No queue at '{args.queue}'", file=sys.stderr)
+        return EXIT_INPUT
+    try:
+        shard_queue = ShardQueue(args.queue)
+    except sqlite3.Error as e:
+        print(f"Unable to open queue '{args.queue}': {e}", file=sys.stderr)
+        return EXIT_INPUT
+    try:
+        if args.command == "queue-status":
+            print_shard_status(shard_queue)
+            return EXIT_OK
+        try:
+            path, songs = read_queue_file(args.file)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Unable to read import file '{args.file}': {e}", file=sys.stderr)
+            return EXIT_INPUT
+        path = os.path.abspath(os.path.expanduser(args.output or path))
+        added, known = shard_queue.publish(path, songs)
+        if not args.quiet:
+            print(f"Published {added} songs to '{args.queue}' ({known} already queued).")
+        return EXIT_OK
+    finally:
+        shard_queue.close()
+
+
+# Runs a command without any prompts, screen clearing or animations. Returns the exit code
+def run_cli(args):
+    import subprocess
+    global SPOTDL_ARGS, SPOTDL_OUTPUT
+    stdout = sys.stdout
+
+    metrics.reset()
+    apply_search_options(args)
+    if args.command in ("publish", "queue-status"):
+        return run_queue_command(args)
+    client_id, client_secret = load_credentials()
+    if not client_id or not client_secret:
+        print("Missing CLIENT_ID / CLIENT_SECRET. Set them in .env or the environment.", file=sys.stderr)
+        return EXIT_AUTH
+    token_manager = TokenManager(client_id, client_secret, TOKEN_CACHE_FILE)
+    try:
+        token = token_manager.get_token()
+    except Exception as e:
+        print(f"Unable to acquire token: {e}", file=sys.stderr)
+        return EXIT_AUTH
+    if token == None:
+        print("Unable to acquire token. Check your API keys.", file=sys.stderr)
+        return EXIT_AUTH
+
+    search_cache = open_search_cache(args, sys.stderr)
+    if args.quiet:
+        SPOTDL_OUTPUT = subprocess.DEVNULL
+    progress = open(os.devnull, 'w') if args.quiet else stdout
+
+    with contextlib.redirect_stdout(progress):
+        if args.command == "search":
+            try:
+                track = find_spotify_track(token_manager, args.song_name, args.artist_name, search_cache)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                return EXIT_FAILED
+            if track == None:
+                if args.quiet:
+                    print(f"No matching tracks found for '{args.song_name}' by '{args.artist_name}'.", file=sys.stderr)
+                return EXIT_FAILED
+            print(f"{track['name']}\t{track['artist']}\t{track['album']}\t{track['url']}", file=stdout)
+            if not is_confident(track):
+                print(f"Uncertain match (score {track['score']:.2f})", file=sys.stderr)
+            return EXIT_OK
+
+        if args.audio_format:
+            SPOTDL_ARGS = SPOTDL_ARGS + ["--format", args.audio_format]
+        try:
+            postprocess = postprocess_options(args.tag, args.transcode, args.replaygain)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return EXIT_USAGE
+
+        import_options = {
+            "search_workers": int(os.getenv("SEARCH_WORKERS", SEARCH_WORKERS)),
+            "download_workers": args.concurrency or int(os.getenv("DOWNLOAD_WORKERS", DOWNLOAD_WORKERS)),
+            "batch_size": int(os.getenv("DOWNLOAD_BATCH_SIZE", DOWNLOAD_BATCH_SIZE)),
+            "search_cache": search_cache,
+            "rebuild_index": args.rebuild_index,
+            "max_bandwidth": args.max_bandwidth,
+            "postprocess": postprocess,
+            "post_workers": args.post_workers,
+        }
+
+        if args.command == "watch":
+            import sqlite3
+
+            def imported(results):
+                metrics.print_summary()
+                export_metrics(args)
+            try:
+                run_watch(token_manager, args.inbox, import_options, interval=args.interval,
+                          status_port=args.status_port, output=args.output, on_import=imported)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Unable to watch '{args.inbox}': {e}", file=sys.stderr)
+                return EXIT_INPUT
+            return EXIT_OK
+
+        if args.command == "worker":
+            import sqlite3
+
+            def imported(results):
+                metrics.print_summary()
+                export_metrics(args)
+            try:
+                failed = run_shard_worker(token_manager, args.queue, import_options, node=args.node, batch=args.batch,
+                                          lease_time=args.lease, follow=args.follow, output=args.output,
+                                          on_import=imported)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Unable to use queue '{args.queue}': {e}", file=sys.stderr)
+                return EXIT_INPUT
+            return EXIT_FAILED if failed else EXIT_OK
+
+        if args.command == "download":
+            if args.artist_name == None:
+                if parse_spotify_url(args.song_name)[0] == None:
+                    print("Give an artist name or a Spotify link.", file=sys.stderr)
+                    return EXIT_USAGE
+                songs = [args.song_name]
+            else:
+                songs = [(args.song_name, args.artist_name)]
+            path = args.output or os.getcwd()
+        else:
+            try:
+                path, songs = iter_import_file(args.file)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Unable to read import file '{args.file}': {e}", file=sys.stderr)
+                return EXIT_INPUT
+            if args.output:
+                path = args.output
+        path = os.path.abspath(os.path.expanduser(path))
+
+        try:
+            results = run_import(token_manager, path, songs, **import_options)
+        except OSError as e:
+            print(f"Failed to create or access folder: {e}", file=sys.stderr)
+            return EXIT_INPUT
+        except (ValueError, KeyError) as e:
+            print(f"Import file '{args.file}' is invalid: {e}", file=sys.stderr)
+            return EXIT_INPUT
+
+        print_import_summary(results)
+        metrics.print_summary()
+    export_metrics(args)
+
+    failed = results.problems
+    if args.quiet:
+        for result in failed:
+            print(f"Not downloaded: '{result['song_name']}' by '{result['artist_name']}': {result['error']}", file=sys.stderr)
+    return EXIT_FAILED if failed else EXIT_OK
+
+
 def main():
+    args = parse_args()
+    if args.command:
+        sys.exit(run_cli(args))
+    apply_search_options(args)
+
+    import sqlite3
+    from dotenv import load_dotenv
+
     # Load env variables
     load_dotenv(override=True)
 
@@ -297,6 +3101,34 @@ def main():
             CLIENT_ID = os.getenv("CLIENT_ID")
             CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
+    # One token manager for the whole session, token is reused until it expires
+    token_manager = TokenManager(CLIENT_ID, CLIENT_SECRET, TOKEN_CACHE_FILE)
+
+    # Cache of search results, shared by both menu paths
+    search_cache = None
+    if not args.no_cache:
+        try:
+            search_cache = SearchCache(SEARCH_CACHE_FILE, refresh=args.refresh)
+        except sqlite3.Error as e:
+            print(f"Search cache disabled: {e}")
+
+    # File import concurrency
+    search_workers = int(os.getenv("SEARCH_WORKERS", SEARCH_WORKERS))
+    download_workers = int(os.getenv("DOWNLOAD_WORKERS", DOWNLOAD_WORKERS))
+    batch_size = int(os.getenv("DOWNLOAD_BATCH_SIZE", DOWNLOAD_BATCH_SIZE))
+    max_bandwidth = None
+    if os.getenv("MAX_BANDWIDTH"):
+        try:
+            max_bandwidth = parse_size(os.getenv("MAX_BANDWIDTH"))
+        except ValueError as e:
+            print(f"Ignoring MAX_BANDWIDTH: {e}")
+    # Post-processing of imported files, off unless one of TAG_FILES=1, TRANSCODE_FORMAT or REPLAYGAIN=1 is set
+    try:
+        postprocess = postprocess_options(os.getenv("TAG_FILES") == "1", os.getenv("TRANSCODE_FORMAT"), os.getenv("REPLAYGAIN") == "1")
+    except ValueError as e:
+        print(f"Post-processing disabled: {e}")
+        postprocess = None
+
     dwn_path=""
     loop=True
     while loop:
@@ -320,8 +3152,10 @@ def main():
             searching_animation(1)
 
             try:
-                token = generate_token(CLIENT_ID,CLIENT_SECRET)
-                artist, album, song, url = search_spotify_song(token, song_name, artist_name)
+                token = token_manager.get_token()
+                if token == None:
+                    raise ValueError("Unable to acquire token")
+                artist, album, song, url = search_spotify_song(token_manager, song_name, artist_name, search_cache)
                 if artist == None and album == None and song == None and url == None:
                     input("Press enter to continue...")
                     continue
@@ -337,9 +3171,16 @@ def main():
                             print()
                             dest_path = set_folder(dwn_path)
                         print_download_menu()
-                        song_path = create_song_folder_structure(dest_path, artist, album, song)
-                        download_spotify_url(url, song_path)
-                        print("Download complete!")
+                        library = LibraryIndex(dest_path, rebuild=args.rebuild_index)
+                        track = {"artist": artist, "album": album, "name": song, "id": None}
+                        if library.has_track(track):
+                            print("Song is already downloaded.")
+                        else:
+                            song_path = create_song_folder_structure(dest_path, artist, album, song)
+                            if download_spotify_url(url, song_path):
+                                library.update_folder(song_path, [track])
+                            print("Download complete!")
+                        library.close()
                         input("\nPress enter to continue...")
                         #print(f"Temp Path: {song_path}")
                     else:
@@ -362,7 +3203,7 @@ def main():
                 import_file_path = input("\nImport file path (example: /home/user/list.json): ")
                 try:
                     input("\nPress enter to submit path (CTL+C -> Enter to go back)...")
-                    path, songs = parse_json_file(import_file_path)
+                    path, songs = iter_import_file(import_file_path)
                 except:
                     print_error_menu()
                     print(f"\nUnable find import file with path '{import_file_path}' provided.")
@@ -388,42 +3229,33 @@ def main():
                 #     input("\nPress enter to continue...")
 
 
-                print_download_menu()
-                for song_name, artist_name in songs:
-                    
-                    token = generate_token(CLIENT_ID,CLIENT_SECRET)
-                    if token == None:
-                        print_error_menu()
-                        print("\nUnable to acquire token. Check your API keys.")
-                        input("\nPress enter to continue...")
-                        break
-
-                    try:
-                        artist, album, song, url = search_spotify_song(token, song_name, artist_name)
-                        if url:
-                            try:
-                                dest_path = set_folder(path)
-                            except OSError as e:
-                                print_error_menu()
-                                print(f"\nFailed to create or access folder: {e}")
-                                input("\nPress enter to continue...")
-                                break
-
-                            song_path = create_song_folder_structure(dest_path, artist, album, song)
-                            download_spotify_url(url, song_path)
-                    except Exception as e:
-                        print_error_menu()
-                        print(f"\nAn error occurred: {e}")
-                        input("\nPress enter to continue...")
-                        continue
-                
-                if token != None and artist != None and album != None and song != None and url != None:
-                    print("Import file completed!")
+                metrics.reset()
+                if token_manager.get_token() == None:
+                    print_error_menu()
+                    print("\nUnable to acquire token. Check your API keys.")
                     input("\nPress enter to continue...")
-                elif artist == None and album == None and song == None and url == None:
+                    continue
+
+                print_download_menu()
+                try:
+                    results = run_import(token_manager, path, songs, search_workers, download_workers, batch_size=batch_size, search_cache=search_cache, rebuild_index=args.rebuild_index, max_bandwidth=max_bandwidth, postprocess=postprocess)
+                except OSError as e:
+                    print_error_menu()
+                    print(f"\nFailed to create or access folder: {e}")
                     input("\nPress enter to continue...")
-                else:
+                    continue
+                except (ValueError, KeyError) as e:
+                    # Songs are read while the import runs so a broken entry only shows up here
+                    print_error_menu()
+                    print(f"\nImport file '{import_file_path}' is invalid: {e}")
                     input("\nPress enter to continue...")
+                    continue
+
+                print_import_summary(results)
+                metrics.print_summary()
+                export_metrics(args)
+                print("\nImport file completed!")
+                input("\nPress enter to continue...")
 
             # except:
             #     print_error_menu()
@@ -445,6 +3277,7 @@ def main():
                 load_dotenv(override=True)  # Reload environment after edit
                 CLIENT_ID = os.getenv("CLIENT_ID")
                 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+                token_manager = TokenManager(CLIENT_ID, CLIENT_SECRET, TOKEN_CACHE_FILE)
 
         elif choice == 4:
             print()
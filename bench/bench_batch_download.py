@@ -0,0 +1,81 @@
+# Compares wall time of downloading songs with one spotDL process per song
+# against one spotDL process per destination folder. Uses the fake spotDL in
+# bench/fake_spotdl so nothing is downloaded.
+#
+# Usage: python bench/bench_batch_download.py [songs] [folders]
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(BENCH_DIR, "..", "CLI-Spotify-DWN.py")
+
+
+# Load the main script as a module (its file name isn't importable)
+def load_downloader():
+    spec = importlib.util.spec_from_file_location("cli_spotify_dwn", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_songs(count, folders):
+    songs = []
+    for i in range(count):
+        songs.append((f"Artist {i % folders}", f"Album {i % folders}", f"Song {i}", f"https://open.spotify.com/track/fake{i:06d}"))
+    return songs
+
+
+def bench_per_track(dwn, root, songs):
+    start = time.perf_counter()
+    failed = 0
+    for artist, album, song, url in songs:
+        song_path = dwn.create_song_folder_structure(root, artist, album, song)
+        if not dwn.download_spotify_url(url, song_path):
+            failed += 1
+    return time.perf_counter() - start, failed
+
+
+def bench_batched(dwn, root, songs):
+    start = time.perf_counter()
+    groups = {}
+    for artist, album, song, url in songs:
+        song_path = dwn.create_song_folder_structure(root, artist, album, song)
+        groups.setdefault(song_path, []).append(url)
+    failed = 0
+    for song_path, urls in groups.items():
+        outcome = dwn.download_spotify_urls(urls, song_path)
+        failed += sum(1 for ok in outcome.values() if not ok)
+    return time.perf_counter() - start, failed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    folders = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    # Point "python -m spotdl" at the fake
+    fake_path = os.path.join(BENCH_DIR, "fake_spotdl")
+    os.environ["PYTHONPATH"] = fake_path + os.pathsep + os.environ.get("PYTHONPATH", "")
+
+    dwn = load_downloader()
+    dwn.SPOTDL_COMMAND = [sys.executable, "-m", "spotdl"]
+    songs = make_songs(count, folders)
+
+    print(f"{count} songs in {folders} folders")
+    print(f"fake spotDL startup {os.getenv('FAKE_SPOTDL_STARTUP', '1.0')}s, per song {os.getenv('FAKE_SPOTDL_TRACK', '0.2')}s\n")
+
+    for name, bench in (("per-track", bench_per_track), ("batched", bench_batched)):
+        root = tempfile.mkdtemp(prefix="spotdl-bench-")
+        try:
+            elapsed, failed = bench(dwn, root, songs)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+        print(f"{name:<10} {elapsed:8.2f}s  {count / elapsed:7.2f} songs/s  {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# Fake spotDL used by the benchmarks. Run it with bench/fake_spotdl on PYTHONPATH
+# so "python -m spotdl" picks this package up instead of the real one.
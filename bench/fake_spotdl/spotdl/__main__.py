@@ -0,0 +1,57 @@
+# Fake "python -m spotdl". Sleeps to simulate startup and download time and
+# writes a placeholder file for every url into the --output folder, named
+# "Artist - Title" like spotDL does (from the stub's links, the track id otherwise).
+#
+# FAKE_SPOTDL_STARTUP - seconds spent starting up (interpreter, imports, ffmpeg), default 1.0
+# FAKE_SPOTDL_TRACK   - seconds spent per song, default 0.2
+# FAKE_SPOTDL_FAIL    - fail (exit code 1) for urls containing this text
+# FAKE_SPOTDL_SIZE    - size in bytes of every placeholder file, default 0
+
+import os
+import sys
+import time
+from urllib.parse import parse_qs, urlparse
+
+
+def main(args):
+    output_folder = "."
+    output_format = "mp3"
+    urls = []
+
+    i = 0
+    while i < len(args):
+        if args[i] == "--output" and i + 1 < len(args):
+            output_folder = args[i + 1]
+            i += 2
+        elif args[i] == "--format" and i + 1 < len(args):
+            output_format = args[i + 1]
+            i += 2
+        elif args[i] == "download":
+            i += 1
+        else:
+            urls.append(args[i])
+            i += 1
+
+    time.sleep(float(os.getenv("FAKE_SPOTDL_STARTUP", "1.0")))
+
+    fail_text = os.getenv("FAKE_SPOTDL_FAIL")
+    size = int(os.getenv("FAKE_SPOTDL_SIZE", "0"))
+    failed = False
+    for url in urls:
+        time.sleep(float(os.getenv("FAKE_SPOTDL_TRACK", "0.2")))
+        if fail_text and fail_text in url:
+            print(f"Failed to download {url}")
+            failed = True
+            continue
+        link = urlparse(url)
+        name = parse_qs(link.query).get("file", [link.path.rstrip("/").split("/")[-1]])[0]
+        file_path = os.path.join(output_folder, f"{name}.{output_format}")
+        if not os.path.exists(file_path):
+            with open(file_path, "wb") as f:
+                f.write(b"\0" * size)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
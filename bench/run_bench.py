@@ -0,0 +1,200 @@
+# Offline throughput benchmark of the import path. Runs parse_json_file -> search ->
+# create_song_folder_structure -> spotDL over synthetic song lists against the local
+# stub API (bench/stub_spotify.py) and the fake spotDL (bench/fake_spotdl), and reports
+# tracks/sec, peak RSS and request counts. Each list size runs in its own process so its
+# peak RSS isn't that of an earlier, bigger run.
+#
+# Usage: python bench/run_bench.py --songs 100 1000 10000 [--latency 0.05] [--rate-429 0.01] [--json results.json]
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_batch_download import BENCH_DIR, load_downloader
+from stub_spotify import StubConfig, start_stub
+
+# Requests/sec let through to the stub. The client's own REQUEST_RATE (10/s, meant for Spotify)
+# would cap every run at about 10 tracks/s and the benchmark would only measure the limiter
+STUB_REQUEST_RATE = 1000
+
+
+def write_song_list(path, download_path, count, artists):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({"download_path": download_path})[:-1] + ', "songs": [')
+        for i in range(count):
+            if i:
+                f.write(",")
+            f.write(json.dumps({"song_name": f"Song {i}", "artist_name": f"Artist {i % artists}"}))
+        f.write("]}")
+
+
+# Peak RSS in MB of this process and of its largest finished child (spotDL)
+def peak_rss():
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, children
+
+
+def run_once(dwn, args, count, stats):
+    work_dir = tempfile.mkdtemp(prefix="spotify-dl-bench-")
+    try:
+        download_path = os.path.join(work_dir, "library")
+        list_path = os.path.join(work_dir, "songs.json")
+        write_song_list(list_path, download_path, count, args.artists)
+
+        search_cache = None
+        if args.cache:
+            search_cache = dwn.SearchCache(os.path.join(work_dir, "search_cache.db"))
+        token_manager = dwn.TokenManager("bench-id", "bench-secret")
+        before = stats.snapshot()
+
+        dwn.metrics.reset()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            if args.stream:
+                path, songs = dwn.iter_import_file(list_path)
+            else:
+                path, songs = dwn.parse_json_file(list_path)
+            results = dwn.run_import(token_manager, path, songs,
+                                     search_workers=args.search_workers,
+                                     download_workers=args.download_workers,
+                                     batch_size=args.batch_size,
+                                     search_cache=search_cache,
+                                     resume=not args.no_resume,
+                                     max_bandwidth=args.max_bandwidth)
+        elapsed = time.perf_counter() - start
+
+        after = stats.snapshot()
+        requests = {path: after["requests"].get(path, 0) - before["requests"].get(path, 0) for path in after["requests"]}
+        statuses = results.counts
+        own_rss, child_rss = peak_rss()
+        snap = dwn.metrics.snapshot()
+        return {
+            "songs": count,
+            "seconds": elapsed,
+            "tracks_per_sec": statuses.get("downloaded", 0) / elapsed,
+            "statuses": statuses,
+            "requests": requests,
+            "requests_total": sum(requests.values()),
+            "throttled": after["throttled"] - before["throttled"],
+            "retries": snap["counters"].get("retries", 0),
+            "spotdl_processes": sum(int(c) for c in snap["spotdl_exit_codes"].values()),
+            "peak_rss_mb": round(own_rss, 1),
+            "peak_child_rss_mb": round(child_rss, 1),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Worker settings left unset on the command line take the downloader's defaults
+def fill_defaults(args, dwn):
+    if args.search_workers == None:
+        args.search_workers = dwn.SEARCH_WORKERS
+    if args.download_workers == None:
+        args.download_workers = dwn.DOWNLOAD_WORKERS
+    if args.batch_size == None:
+        args.batch_size = dwn.DOWNLOAD_BATCH_SIZE
+
+
+# Starts the stub API and points the downloader and the fake spotDL at it
+def start_bench(args):
+    # Fake spotDL for the child processes
+    os.environ["PYTHONPATH"] = os.path.join(BENCH_DIR, "fake_spotdl") + os.pathsep + os.environ.get("PYTHONPATH", "")
+    os.environ["FAKE_SPOTDL_STARTUP"] = str(args.spotdl_startup)
+    os.environ["FAKE_SPOTDL_TRACK"] = str(args.spotdl_track)
+    os.environ["FAKE_SPOTDL_SIZE"] = str(args.file_size)
+
+    config = StubConfig(args.latency, args.jitter, args.rate_429, args.retry_after, args.payload_bytes)
+    server, base_url, stats = start_stub(config)
+
+    dwn = load_downloader()
+    dwn.TOKEN_URL = base_url + "/api/token"
+    dwn.API_URL = base_url + "/v1"
+    dwn.SEARCH_URL = dwn.API_URL + "/search"
+    dwn.TRACKS_URL = dwn.API_URL + "/tracks"
+    dwn.SPOTDL_COMMAND = [sys.executable, "-m", "spotdl"]
+    dwn.SPOTDL_OUTPUT = subprocess.DEVNULL
+    # RequestScheduler's defaults were bound when it was defined, setting REQUEST_RATE isn't enough
+    dwn._scheduler = dwn.RequestScheduler(rate=args.rate, burst=max(dwn.REQUEST_BURST, int(args.rate)))
+    fill_defaults(args, dwn)
+    return server, stats, dwn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the import path.")
+    parser.add_argument("--songs", type=int, nargs="+", default=[100, 1000], help="song list sizes to run")
+    parser.add_argument("--artists", type=int, default=50, help="distinct artists in the synthetic lists")
+    parser.add_argument("--latency", type=float, default=0.02, help="stub API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of stub API requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--payload-bytes", type=int, default=2000, help="padding per track object in stub answers")
+    parser.add_argument("--spotdl-startup", type=float, default=0.05, help="fake spotDL startup seconds")
+    parser.add_argument("--spotdl-track", type=float, default=0.01, help="fake spotDL seconds per song")
+    parser.add_argument("--file-size", type=int, default=0, help="bytes written per fake download")
+    parser.add_argument("--search-workers", type=int, default=None)
+    parser.add_argument("--download-workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=None)
+    parser.add_argument("--max-bandwidth", type=int, default=None, help="download bandwidth cap in bytes/sec")
+    parser.add_argument("--rate", type=float, default=STUB_REQUEST_RATE,
+                        help=f"request scheduler's requests/sec, lower it to bench against the client's limit (default: {STUB_REQUEST_RATE})")
+    parser.add_argument("--cache", action="store_true", help="use a (fresh) search cache")
+    parser.add_argument("--stream", action="store_true", help="read the list with iter_import_file instead of parse_json_file")
+    parser.add_argument("--no-resume", action="store_true", help="don't write the manifest or library index")
+    parser.add_argument("--json", metavar="FILE", help="also write the results to a json file")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # One list size, run by the parent in its own process
+    if args.run_one:
+        server, stats, dwn = start_bench(args)
+        try:
+            run = run_once(dwn, args, args.run_one, stats)
+        finally:
+            server.shutdown()
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(run, f)
+        return
+
+    dwn = load_downloader()
+    fill_defaults(args, dwn)
+
+    print(f"stub latency {args.latency}s (+{args.jitter}s), 429 rate {args.rate_429}, "
+          f"fake spotDL {args.spotdl_startup}s + {args.spotdl_track}s/song")
+    print(f"search workers {args.search_workers}, download workers {args.download_workers}, batch size {args.batch_size}, "
+          f"request rate {args.rate:g}/s (client default {dwn.REQUEST_RATE}/s)\n")
+    print(f"{'songs':>8}{'seconds':>10}{'tracks/s':>10}{'requests':>10}{'429s':>7}{'retries':>9}{'spotDL':>8}{'RSS MB':>8}")
+
+    runs = []
+    for count in args.songs:
+        # Every size runs in a fresh process: ru_maxrss only ever goes up, so in one process
+        # each run would report the peak of the largest list so far
+        fd, result_path = tempfile.mkstemp(prefix="spotify-dl-bench-", suffix=".json")
+        os.close(fd)
+        try:
+            subprocess.run([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                           ["--run-one", str(count), "--result-file", result_path], check=True)
+            with open(result_path, 'r', encoding='utf-8') as f:
+                run = json.load(f)
+        finally:
+            os.remove(result_path)
+        runs.append(run)
+        print(f"{run['songs']:>8}{run['seconds']:>10.2f}{run['tracks_per_sec']:>10.1f}{run['requests_total']:>10}"
+              f"{run['throttled']:>7}{run['retries']:>9}{run['spotdl_processes']:>8}{run['peak_rss_mb']:>8.1f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"settings": vars(args), "runs": runs}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# Local stand-in for the parts of the Spotify API the downloader uses:
+# POST /api/token, GET /v1/search and GET /v1/tracks.
+#
+# Every search matches a made up track built from the query, so any song list works.
+# Latency, 429 answers and the size of each track object can be configured.
+#
+# Usage: python bench/stub_spotify.py [--port 8765] [--latency 0.05] [--rate-429 0.01]
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+
+class StubConfig:
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1, payload_bytes=0, albums=3):
+        # Seconds added to every answer (plus up to jitter seconds)
+        self.latency = latency
+        self.jitter = jitter
+        # Share of API requests answered with 429 and the Retry-After sent with them
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        # Extra bytes of padding in every track object (real ones carry ~2kB of available_markets)
+        self.payload_bytes = payload_bytes
+        # Made up tracks are spread over this many albums per artist
+        self.albums = albums
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.throttled = 0
+
+    def count(self, path, throttled=False):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            if throttled:
+                self.throttled += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": dict(self.requests), "total": sum(self.requests.values()), "throttled": self.throttled}
+
+
+def make_track(track_id, name, artist, config):
+    digest = int(hashlib.md5(track_id.encode()).hexdigest(), 16)
+    track = {
+        "id": track_id,
+        "name": name,
+        "type": "track",
+        "duration_ms": 120000 + digest % 240000,
+        "popularity": digest % 100,
+        "artists": [{"name": artist}],
+        "album": {"name": f"Album {digest % config.albums}", "album_type": "album"},
+        # The fake spotDL only gets the link, the file name spotDL would use ("Artist - Title")
+        # comes along in it like the ?si= parameter of shared links
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}?file={quote(f'{artist} - {name}')}"},
+    }
+    if config.payload_bytes:
+        track["padding"] = "x" * config.payload_bytes
+    return track
+
+
+def track_id_for(text):
+    return hashlib.md5(text.encode()).hexdigest()[:22]
+
+
+def make_handler(config, stats):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep-alive like the real API
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, data, headers=None):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def delay(self):
+            if config.latency or config.jitter:
+                time.sleep(config.latency + random.uniform(0, config.jitter))
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+            stats.count(path)
+            self.delay()
+            if path == "/api/token":
+                self.send_json(200, {"access_token": "stub-token", "token_type": "Bearer", "expires_in": 3600})
+            else:
+                self.send_json(404, {"error": "not found"})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if random.random() < config.rate_429:
+                stats.count(url.path, throttled=True)
+                self.send_json(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                               {"Retry-After": str(config.retry_after)})
+                return
+            stats.count(url.path)
+            self.delay()
+
+            if url.path == "/v1/search":
+                q = query.get("q", [""])[0]
+                limit = int(query.get("limit", ["1"])[0])
+                match = re.match(r'track:(.*) artist:(.*)', q)
+                name, artist = match.groups() if match else (q, "Unknown")
+                items = []
+                for i in range(limit):
+                    version = name if i == 0 else f"{name} - Live"
+                    items.append(make_track(track_id_for(f"{q}:{i}"), version, artist, config))
+                self.send_json(200, {"tracks": {"items": items, "limit": limit, "total": limit}})
+            elif url.path == "/v1/tracks":
+                ids = query.get("ids", [""])[0].split(",")
+                self.send_json(200, {"tracks": [make_track(i, f"Track {i[:6]}", "Stub Artist", config) for i in ids]})
+            else:
+                self.send_json(404, {"error": {"status": 404, "message": "Not found"}})
+
+    return Handler
+
+
+# Starts the stub in a background thread. Returns (server, base url, stats)
+def start_stub(config=None, port=0):
+    config = config or StubConfig()
+    stats = StubStats()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config, stats))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Spotify API.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many extra seconds per answer")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of API requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--payload-bytes", type=int, default=0, help="padding added to every track object")
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency, args.jitter, args.rate_429, args.retry_after, args.payload_bytes)
+    server, base_url, stats = start_stub(config, args.port)
+    print(f"Stub Spotify API on {base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(stats.snapshot(), indent=2))
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()